@@ -0,0 +1,298 @@
+# asyncio version of RayboxZeroController (see raybox_controller.py), for driving raybox-zero on a TT04 board
+# without blocking, e.g. so one host process can drive several boards (or a game plus a telemetry server)
+# concurrently without threads, and without one stalled device holding up the rest:
+#
+#   raybox = await AsyncRayboxZeroController.open('/dev/ttyACM0')
+#   await raybox.set_raw_pov(pov)
+#   await raybox.set_sky(0b_01_01_01)
+#   await raybox.close()
+#
+# Reads and writes never block: where the serial port has a file descriptor (i.e. a real port on Linux/macOS)
+# the event loop tells us when data arrives, or when the port can take more of what we're sending, otherwise
+# (e.g. Windows, or an emulated board) we poll every POLL_INTERVAL.
+# Every wait for the device has a timeout (raising asyncio.TimeoutError), and like any other await,
+# can be cancelled. Calls on one controller are serialised (by a lock), so they can be made from
+# several tasks at once. Packets and settings (USE_STREAM, PIPELINE_DEPTH, etc.) are shared with raybox_controller.py.
+#
+# Run it directly to spin the view on one or more boards at once, e.g.:
+#   python3 raybox_async.py --port COM3 --port COM4 --updates 500
+
+import asyncio
+import collections
+import math
+import os
+import time
+from pathlib import Path
+import serial
+from raybox_controller import (
+    default_port, pov_bits, pov_packet, reg_packet, RayboxCommandError, RESYNC, REG_CMDS,
+    USE_STREAM, VBLANK_SYNC, FAST_RECONNECT, PIPELINE_DEPTH, PATH_TO_RAYBOX_PERIPHERAL_CODE, CLOCK_SPEED, MACHINE_FREQ,
+    DEVICE_STATE_QUERY, parse_device_state, expected_device_state,
+    take_marker, exit_raw_mode_steps, enter_raw_mode_steps, raw_exec_steps, start_stream_steps, stop_stream_steps,
+    ack_steps, ack_due,
+)
+
+POLL_INTERVAL = 0.001 # Seconds between checks for received data, if the event loop can't watch the port for us.
+
+# Represents a serial connection to a MicroPython device. Use 'await AsyncMicroPythonInterface.open(port)'.
+class AsyncMicroPythonInterface:
+    # 'port' and 'conn' are as per MicroPythonInterface.
+    def __init__(self, port=None, conn=None):
+        if conn is not None:
+            self.port = getattr(conn, 'port', None) if port is None else port
+            self.conn = conn
+        else:
+            if port is None: port = default_port(self.__class__.__name__)
+            self.port = port
+            self.conn = serial.serial_for_url(self.port, baudrate=9600)
+        self.conn.timeout = 0 # Non-blocking reads...
+        self.conn.write_timeout = 0 # ...and writes.
+        self.rx = bytearray() # Received data that await_bytes hasn't consumed yet.
+        self.tx = bytearray() # Data written that the port hasn't taken yet.
+        self.writing = False # True while the event loop is watching for the port to be writable.
+        self.lock = asyncio.Lock() # Held for the whole of each public call, so they don't interleave.
+        self.readable = asyncio.Event()
+        self.loop = asyncio.get_running_loop()
+        try:
+            self.fd = self.conn.fileno()
+            self.loop.add_reader(self.fd, self.readable.set)
+        except (AttributeError, OSError, ValueError, NotImplementedError):
+            self.fd = None # Fall back to polling.
+
+    @classmethod
+    async def open(cls, port=None, conn=None):
+        self = cls(port, conn)
+        await self.setup()
+        return self
+
+    async def setup(self):
+        pass
+
+    async def close(self):
+        if self.fd is not None:
+            self.loop.remove_reader(self.fd)
+            if self.writing: self.loop.remove_writer(self.fd)
+        self.conn.close()
+
+    # Queue data to be sent, and send as much of it as the port will take right now:
+    def write(self, *data):
+        for p in data:
+            self.tx += bytes(p, 'utf-8') if type(p) is str else p
+        self.send_pending()
+
+    # Send as much of self.tx as the port will take without blocking. If any is left over, the event loop
+    # calls this again as soon as the port is writable (or, if it can't watch the port, receive() does):
+    def send_pending(self):
+        if self.tx:
+            if self.fd is None:
+                n = self.conn.write(self.tx) or 0
+            else:
+                # (Straight to the fd, as pyserial's write() spins while the port is full, even with write_timeout=0.)
+                try:
+                    n = os.write(self.fd, self.tx)
+                except BlockingIOError:
+                    n = 0
+            del self.tx[:n]
+        if self.fd is not None and bool(self.tx) != self.writing:
+            if self.tx:
+                self.loop.add_writer(self.fd, self.send_pending)
+            else:
+                self.loop.remove_writer(self.fd)
+            self.writing = bool(self.tx)
+
+    # Wait until more data has been received, and add it to self.rx:
+    async def receive(self):
+        while True:
+            if self.fd is None: self.send_pending()
+            self.readable.clear()
+            r = self.conn.read(self.conn.in_waiting)
+            if len(r) > 0:
+                self.rx += r
+                return
+            if self.fd is None:
+                await asyncio.sleep(POLL_INTERVAL)
+            else:
+                await self.readable.wait()
+
+    # Like MicroPythonInterface.await_bytes, but raises asyncio.TimeoutError on timeout:
+    async def await_bytes(self, mark, timeout=5.0):
+        if type(mark) is not list: mark = [mark]
+        return await asyncio.wait_for(self.find_bytes(mark), timeout)
+
+    async def find_bytes(self, mark):
+        scanned = 0 # How much of self.rx has already been searched for the marks.
+        while True:
+            r = take_marker(self.rx, mark, scanned)
+            if r is not None: return r
+            scanned = len(self.rx)
+            await self.receive()
+
+    # Like MicroPythonInterface.run_steps, for the same conversations (from raybox_controller.py):
+    async def run_steps(self, steps):
+        r = None
+        try:
+            while True:
+                step = steps.send(r)
+                if type(step) is list:
+                    r = await self.await_bytes(step)
+                else:
+                    self.write(step)
+                    r = None
+        except StopIteration as e:
+            return e.value
+
+    async def exit_raw_mode(self):
+        await self.run_steps(exit_raw_mode_steps())
+
+    async def enter_raw_mode(self):
+        await self.run_steps(enter_raw_mode_steps())
+
+    async def raw_exec(self, data, decode_response='utf-8'):
+        out = await self.run_steps(raw_exec_steps(data))
+        return out if decode_response is None else out.decode(decode_response)
+
+    async def exec(self, data):
+        async with self.lock:
+            return (await self.raw_exec(data, 'ascii')).strip()
+
+
+# Represents raybox-zero on a TT04 board. Use 'await AsyncRayboxZeroController.open(port)' (or 'open(conn=...)').
+class AsyncRayboxZeroController(AsyncMicroPythonInterface):
+    UI_DEBUG    = 3
+
+    def __init__(self, port=None, conn=None):
+        super().__init__(port, conn)
+        self.streaming = False
+        self.pipeline_depth = PIPELINE_DEPTH
+        self.in_flight = collections.deque() # Stream packets sent (with time.perf_counter_ns() when), but not yet acknowledged.
+        self.on_ack = None # As per RayboxZeroController.on_ack.
+        self.vblank_sync = False
+
+    # Same steps as TT04 and RayboxZeroController's constructors:
+    async def setup(self):
+        async with self.lock:
+            self.write(RESYNC, b'\x03\x03') # Stop serve() or any other running program.
+            await self.enter_raw_mode()
+            peripheral_code_path = os.path.join(
+                os.path.dirname(os.path.abspath(__file__)),
+                PATH_TO_RAYBOX_PERIPHERAL_CODE
+            )
+            remote_api_code = Path(peripheral_code_path).read_text()
+            setup = expected_device_state(remote_api_code)
+            code_hash = setup[-1]
+            state = parse_device_state((await self.raw_exec(DEVICE_STATE_QUERY, 'ascii')).strip())
+            if FAST_RECONNECT and state == setup:
+                print(f'Board is already set up, with the same raybox_peripheral.py ({code_hash}); skipping setup and upload')
+                await self.raw_exec('tt.input_byte=0b0000_1000')
+            else:
+                await self.raw_exec('tt.mode=RPMode.ASIC_RP_CONTROL')
+                await self.raw_exec('tt.input_byte=0b0000_1000')
+                await self.raw_exec('tt.shuttle.tt_um_algofoogle_raybox_zero.enable()')
+                await self.raw_exec(f'machine.freq({int(MACHINE_FREQ)})')
+                await self.raw_exec(f'tt.clock_project_PWM({int(CLOCK_SPEED)})')
+                await self.raw_exec('tt.reset_project(True)')
+                await asyncio.sleep(0.1)
+                await self.raw_exec('tt.reset_project(False)')
+                await self.raw_exec(remote_api_code)
+                await self.raw_exec(f'RBZ_CODE_HASH={repr(code_hash)}')
+            if not (USE_STREAM and VBLANK_SYNC): await self.raw_exec('vblank.enable(False)')
+            if USE_STREAM:
+                await self.start_stream()
+                if VBLANK_SYNC:
+                    await self.send_packet(b'B\x01')
+                    self.vblank_sync = True
+
+    # As per RayboxZeroController.device_state:
+    async def device_state(self):
+        return parse_device_state(await self.exec(DEVICE_STATE_QUERY))
+
+    async def close(self):
+        async with self.lock:
+            await self.stop_stream()
+        await super().close()
+
+    async def start_stream(self):
+        if self.streaming: return
+        await self.run_steps(start_stream_steps())
+        self.streaming = True
+
+    async def stop_stream(self):
+        if not self.streaming: return
+        await self.check_acks(0)
+        self.streaming = False
+        await self.run_steps(stop_stream_steps())
+
+    # Anything other than a POV or REG update has to go via the raw REPL, so pause streaming for it:
+    async def raw_exec(self, data, decode_response='utf-8'):
+        if not self.streaming:
+            return await super().raw_exec(data, decode_response)
+        await self.stop_stream()
+        try:
+            return await super().raw_exec(data, decode_response)
+        finally:
+            await self.start_stream()
+
+    async def send_packet(self, packet):
+        self.write(packet)
+        self.in_flight.append((packet, time.perf_counter_ns()))
+        await self.check_acks(self.pipeline_depth - 1)
+
+    # As per RayboxZeroController.check_acks:
+    async def check_acks(self, max_in_flight):
+        while ack_due(self.in_flight, max_in_flight, len(self.rx) + self.conn.in_waiting):
+            acked = await self.run_steps(ack_steps(self.in_flight))
+            if self.on_ack is not None: self.on_ack(*acked)
+
+    async def flush(self):
+        async with self.lock:
+            await self.check_acks(0)
+
+    async def set_raw_pov(self, pov):
+        async with self.lock:
+            if self.streaming:
+                return await self.send_packet(pov_packet(pov))
+            return (await self.raw_exec(f'pov.set_raw_pov({repr(pov)})', 'ascii')).strip()
+
+    async def call_peripheral_method(self, interface, method, data):
+        async with self.lock:
+            if self.streaming and interface == 'reg' and method in REG_CMDS:
+                return await self.send_packet(reg_packet(REG_CMDS[method], int(data)))
+            return (await self.raw_exec(f'{interface}.{method}({int(data)})', 'ascii')).strip()
+
+    async def set_sky(self, color):
+        return await self.call_peripheral_method('reg', 'sky', color)
+
+    async def set_floor(self, color):
+        return await self.call_peripheral_method('reg', 'floor', color)
+
+    async def set_leak(self, leak):
+        return await self.call_peripheral_method('reg', 'leak', leak)
+
+    async def debug(self, state):
+        return await self.exec(f'tt.in{self.UI_DEBUG}({state})')
+
+    async def toggle_debug(self):
+        return int(await self.exec(f'tt.in{self.UI_DEBUG}.toggle();print(tt.in{self.UI_DEBUG}())'))
+
+
+# Spin the view on each board, all at the same time, and report how long each took:
+async def spin(ports, updates):
+    povs = [pov_bits(6.82, 9.5, 2.0*math.pi*i/updates) for i in range(updates)]
+    boards = await asyncio.gather(*[AsyncRayboxZeroController.open(port) for port in ports])
+    async def run(raybox):
+        start = time.perf_counter()
+        for pov in povs: await raybox.set_raw_pov(pov)
+        await raybox.flush()
+        print(f"{raybox.port}: {updates/(time.perf_counter()-start):.1f} updates/sec")
+    try:
+        await asyncio.gather(*[run(raybox) for raybox in boards])
+    finally:
+        for raybox in boards: await raybox.close()
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Spin the view on one or more TT04 boards concurrently, using asyncio')
+    parser.add_argument('--port', action='append', help='Serial port or pyserial URL; repeat for more boards (default: last COM port)')
+    parser.add_argument('--updates', type=int, default=500, help='No. of POV updates to send to each board')
+    args = parser.parse_args()
+    asyncio.run(spin(args.port or [None], args.updates))
@@ -0,0 +1,151 @@
+# Headless benchmark of the host -> RP2040 -> SPI -> raybox-zero update path.
+# This measures how quickly RayboxZeroController can push POV updates and register writes,
+# and writes the results as JSON so they can be compared between runs, e.g.:
+#   python3 raybox_benchmark.py --updates 1000 --output bench.json
+#
+# By default this uses the same port as raybox_game.py (i.e. the last COM port), but --port
+# also accepts any pyserial URL, and --emulate runs it against an emulated board (see raybox_emulator.py)
+# with the given USB latency and jitter, e.g.:
+#   python3 raybox_benchmark.py --emulate --latency 0.5 --jitter 0.2
+
+import argparse
+import contextlib
+import json
+import math
+import platform
+import statistics
+import sys
+import time
+from raybox_controller import RayboxZeroController, pov_bits
+from raybox_emulator import EmulatedSerial
+
+# Nearest-rank percentile of an already-sorted list:
+def percentile(sorted_values, p):
+    if len(sorted_values) == 0: return None
+    k = max(0, math.ceil(p/100.0*len(sorted_values)) - 1)
+    return sorted_values[k]
+
+# Summarise a list of per-call latencies (in ns), given the total elapsed time (in ns).
+# 'Jitter' is the standard deviation of the latency; all times are reported in ms.
+def summarize(latencies, elapsed):
+    s = sorted(latencies)
+    ms = lambda ns: None if ns is None else ns/1_000_000
+    return {
+        'count':        len(s),
+        'elapsed_ms':   ms(elapsed),
+        'per_sec':      len(s) / (elapsed/1e9) if elapsed else None,
+        'latency_ms': {
+            'min':      ms(s[0]) if s else None,
+            'p50':      ms(percentile(s, 50)),
+            'p90':      ms(percentile(s, 90)),
+            'p99':      ms(percentile(s, 99)),
+            'max':      ms(s[-1]) if s else None,
+            'mean':     ms(statistics.fmean(s)) if s else None,
+        },
+        'jitter_ms':    ms(statistics.pstdev(s)) if len(s) > 1 else 0.0,
+    }
+
+# Time each of 'count' calls of fn(i). Calls might return before the device has finished with
+# them (if the controller is pipelining), so the total elapsed time also includes finish():
+def time_calls(fn, count, finish=None):
+    latencies = []
+    start = time.perf_counter_ns()
+    for i in range(count):
+        t = time.perf_counter_ns()
+        fn(i)
+        latencies.append(time.perf_counter_ns() - t)
+    if finish is not None: finish()
+    return summarize(latencies, time.perf_counter_ns() - start)
+
+# Time 'count' calls of fn(i), each of which sends one stream packet. With pipelining, a call returns as soon as
+# its packet is written, so instead of timing the calls, each latency is from sending a packet until its ack was
+# processed (see RayboxZeroController.on_ack). Without streaming, a call only returns once the board has run it,
+# so time_calls() already covers that:
+def time_acks(raybox, fn, count):
+    if not raybox.streaming: return time_calls(fn, count, raybox.flush)
+    raybox.flush() # Don't count anything that was already in flight.
+    latencies = []
+    raybox.on_ack = lambda packet, sent: latencies.append(time.perf_counter_ns() - sent)
+    try:
+        start = time.perf_counter_ns()
+        for i in range(count): fn(i)
+        raybox.flush()
+        return summarize(latencies, time.perf_counter_ns() - start)
+    finally:
+        raybox.on_ack = None
+
+# Full rotation (in 'count' steps) on the spot, so every update is a different POV:
+def bench_pov(raybox, count):
+    povs = [pov_bits(6.82, 9.5, 2.0*math.pi*i/count) for i in range(count)]
+    return time_acks(raybox, lambda i: raybox.set_raw_pov(povs[i]), count)
+
+# The same, but with vblank sync on, so the RP2040 only passes on the newest POV at each vblank. The acks then
+# only cover the host <-> RP2040 round trip, so this also reports how many POVs actually reached the ASIC (updated),
+# and how many were replaced by a newer one first (dropped):
+def bench_pov_vblank(raybox, count):
+    before = raybox.vblank_stats()
+    results = bench_pov(raybox, count)
+    after = raybox.vblank_stats()
+    results['vblank'] = { k: after[k] - before[k] for k in after }
+    return results
+
+# Cycle the sky colour through all its values:
+def bench_regs(raybox, count):
+    return time_acks(raybox, lambda i: raybox.set_sky(i % 64), count)
+
+# Connect to the board and run the benchmarks, returning the results:
+def run(args):
+    conn = EmulatedSerial(args.latency/1000.0, args.jitter/1000.0, args.seed) if args.emulate else None
+    init_start = time.perf_counter_ns()
+    raybox = RayboxZeroController(args.port, conn=conn)
+    init_ms = (time.perf_counter_ns() - init_start)/1_000_000
+    # Time every POV all the way to the ASIC first, rather than just to the RP2040 (if vblank sync is on):
+    vblank_sync = raybox.vblank_sync
+    if vblank_sync: raybox.set_vblank_sync(False)
+
+    results = {
+        'timestamp':    time.strftime('%Y-%m-%dT%H:%M:%S%z'),
+        'port':         raybox.port,
+        'host':         platform.node(),
+        'python':       platform.python_version(),
+        'init_ms':      init_ms,
+        'pipeline_depth': raybox.pipeline_depth if raybox.streaming else None,
+        'pov':          bench_pov(raybox, args.updates),
+        'reg':          bench_regs(raybox, args.regs),
+    }
+    if vblank_sync:
+        raybox.set_vblank_sync(True)
+        results['pov_vblank'] = bench_pov_vblank(raybox, args.updates)
+    return results
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark POV/register update throughput and latency')
+    parser.add_argument('--port', help='Serial port or pyserial URL (default: last COM port)')
+    parser.add_argument('--updates', type=int, default=500, help='No. of POV updates to time')
+    parser.add_argument('--regs', type=int, default=200, help='No. of register writes to time')
+    parser.add_argument('--output', help='Write results as JSON to this file (default: stdout)')
+    parser.add_argument('--emulate', action='store_true', help='Use an emulated board instead of a real one')
+    parser.add_argument('--latency', type=float, default=0.0, help='With --emulate: USB latency each way, in ms')
+    parser.add_argument('--jitter', type=float, default=0.0, help='With --emulate: max. random extra latency, in ms')
+    parser.add_argument('--seed', type=int, default=0, help='With --emulate: seed for the jitter')
+    args = parser.parse_args()
+
+    # The controller reports its progress on stdout, so send all that to stderr, leaving stdout for the JSON:
+    with contextlib.redirect_stdout(sys.stderr):
+        results = run(args)
+    text = json.dumps(results, indent=2)
+    if args.output is None:
+        print(text)
+    else:
+        with open(args.output, 'w') as f:
+            f.write(text + '\n')
+        print(f"POV: {results['pov']['per_sec']:.1f} updates/sec, p50 {results['pov']['latency_ms']['p50']:.3f} ms, "
+              f"p99 {results['pov']['latency_ms']['p99']:.3f} ms; REG: {results['reg']['per_sec']:.1f} writes/sec. "
+              f"Wrote {args.output}", file=sys.stderr)
+        if 'pov_vblank' in results:
+            v = results['pov_vblank']
+            print(f"POV with vblank sync: {v['per_sec']:.1f} updates/sec sent, of which {v['vblank']['updated']} "
+                  f"reached the ASIC and {v['vblank']['dropped']} were dropped", file=sys.stderr)
+
+if __name__ == '__main__':
+    main()
@@ -6,37 +6,218 @@
 
 import time
 import sys
+import math
+import collections
+import ast
+import hashlib
+import subprocess
+import tempfile
 import serial
 import serial.tools.list_ports
 import os
 from pathlib import Path
 
 PATH_TO_RAYBOX_PERIPHERAL_CODE = './raybox_peripheral.py'
+PROJECT = 'tt_um_algofoogle_raybox_zero'
 CLOCK_SPEED = 25_000_000  # Clock for design. 25.175MHz is 'typical' VGA clock, at 59.94fps
 MACHINE_FREQ = 225_000_000 # RP2040 clock. This should be an integer multiple (2+) of CLOCK_SPEED.
 
 DEBUG = False
+USE_STREAM = True # Send POV/REG updates as binary packets to serve() in raybox_peripheral.py, instead of as Python source.
+PIPELINE_DEPTH = 4 # Max. stream packets in flight before we wait for acks. 1 means wait for each packet's ack.
+VBLANK_SYNC = True # Have the RP2040 hold each POV until the next vblank, so the ASIC gets at most one per frame (needs USE_STREAM).
+FAST_RECONNECT = True # Skip setup/upload steps that the board says it has already done (for the same code and settings).
+USE_MPY = False # Upload raybox_peripheral.py precompiled (by MPY_CROSS) to the board's filesystem, and import it from there.
+MPY_CROSS = ['mpy-cross', '-march=armv6m'] # Must match the board's MicroPython version.
+POV_HEARTBEAT = 0.5 # Seconds. commit() skips a POV identical to the last one sent, unless it's been this long. 0 means always send.
+
+# Register commands for REG (SPI2) writes, per raybox_peripheral.py:
+REG_CMDS = {
+    'sky':      0,
+    'floor':    1,
+    'leak':     2,
+}
+
+# Packets understood by serve() in raybox_peripheral.py.
+# POV is 74 bits (string of binary digits, or int) sent MSB first, zero-padded to 10 bytes:
+def pov_packet(pov):
+    if type(pov) is str: pov = int(pov, 2)
+    return b'P' + (pov << 6).to_bytes(10, 'big')
+
+# Make a 74-bit POV string (as per Player.fixed() in raybox_game.py) for the player at (px,py) facing angle 'a':
+def pov_bits(px, py, a):
+    sina, cosa = math.sin(a), math.cos(a)
+    values = [
+        (px, 15), (py, 15),
+        (sina, 11), (cosa, 11),
+        (-cosa*0.5, 11), (sina*0.5, 11),
+    ]
+    return ''.join(bin(int(v*512.0) & ((1<<bits)-1))[2:].zfill(bits) for v, bits in values)
+
+# REG write is a 4-bit command and 6-bit value, zero-padded to 2 bytes:
+def reg_packet(cmd, value):
+    return b'R' + ((((cmd & 0xF) << 6) | (value & 0x3F)) << 6).to_bytes(2, 'big')
+
+# Sent to stop a serve() that a previous session may have left running. serve() ignores CTRL+C, but exits on b'X'.
+# First, enough b'~' are sent to complete any packet it has partly received, which it then rejects (see serve()),
+# and it answers the rest with b'?'. If serve() isn't running, it's all just junk typed in at the REPL:
+RESYNC = b'~' * 11 + b'X'
+
+# Asks the board what it is actually set up with (see RayboxZeroController.device_state), i.e. (selected project,
+# project clock in Hz, machine.freq(), whether the RP2040 is driving the ASIC's inputs, hash of the raybox_peripheral.py
+# it was sent). Only the hash is something we asked it to remember (in RBZ_CODE_HASH); the rest is read back from the
+# demoboard SDK's project mux (tt.shuttle.enabled) and project clock PWM (tt._clock_pwm):
+DEVICE_STATE_QUERY = (
+    "_p=getattr(tt.shuttle,'enabled',None);_c=getattr(tt,'_clock_pwm',None);"
+    "print(repr(getattr(_p,'name',None)),_c.freq() if _c else 0,machine.freq(),"
+    "tt.mode==RPMode.ASIC_RP_CONTROL,repr(globals().get('RBZ_CODE_HASH')));del _p,_c"
+)
+
+# Parse the board's reply to DEVICE_STATE_QUERY, or return None if it doesn't make sense:
+def parse_device_state(r):
+    try:
+        project, clock, freq, mode, code_hash = r.split()
+        return (ast.literal_eval(project), int(clock), int(freq), ast.literal_eval(mode), ast.literal_eval(code_hash))
+    except Exception:
+        return None
+
+# What DEVICE_STATE_QUERY should say once the board is set up with the given raybox_peripheral.py source
+# (and its hash is kept in RBZ_CODE_HASH). It stays that way for as long as MicroPython keeps running, so if
+# an earlier session already did it all, the setup and upload can be skipped (see FAST_RECONNECT):
+def expected_device_state(code):
+    code_hash = hashlib.sha1(code.encode('utf-8')).hexdigest()[:16]
+    return (PROJECT, int(CLOCK_SPEED), int(MACHINE_FREQ), True, code_hash)
+
+# Raised when the device reports that a command failed. This can be some time after the command was sent
+# (when pipelining), so 'command' says which one it was:
+class RayboxCommandError(Exception):
+    def __init__(self, command, message):
+        super().__init__(f'Command {command} failed: {message}')
+        self.command = command
+        self.message = message
+
+# Find whichever of 'marks' is completed earliest in 'buf' (a bytearray of received data). Only buf[scanned:] is
+# searched (plus enough overlap for a mark split across reads), so it can be called again as more data arrives.
+# If a mark is found, it and everything before it is removed from buf, and (mark, data before it) is returned:
+def take_marker(buf, marks, scanned=0):
+    found = None
+    for m in marks:
+        n = buf.find(m, max(0, scanned - len(m) + 1))
+        if n >= 0 and (found is None or n + len(m) < found[0] + len(found[1])):
+            found = (n, m)
+    if found is None: return None
+    n, m = found
+    data = bytes(buf[:n])
+    del buf[:n+len(m)]
+    return (m, data)
+
+# Conversations with the raw REPL and serve(), shared by RayboxZeroController and AsyncRayboxZeroController
+# (see raybox_async.py). These do no I/O themselves; each is a generator that yields what it needs next:
+# - bytes (or str) to send; or
+# - a list of marks to wait for, after which it is sent back the result of await_bytes, i.e. (mark, data before it).
+# It finally returns its result. run_steps() in each class does the actual sending and receiving.
+def exit_raw_mode_steps():
+    yield b'\x02' # Send CTRL+B
+    yield [b'>>> ']
+
+def enter_raw_mode_steps():
+    yield from exit_raw_mode_steps()
+    yield b'\x01' # Send CTRL+A
+    yield [b'\nraw REPL; CTRL-B to exit\n>', b'\r\nraw REPL; CTRL-B to exit\r\n>']
+
+# Returns the output (as bytes) of running 'data':
+def raw_exec_steps(data):
+    yield data
+    yield b'\x04'
+    # Expect acknowledgement of CTRL+D:
+    yield [b'OK']
+    # Expect first EOT to mark start of response, then wait until the next EOT to mark the end of it:
+    out = yield [b'\x04']
+    r = yield [b'\x04>']
+    if len(r[1]) != 0:
+        raise Exception(f'Got unexpected response to [{data}] from raw_exec: {r[1]}')
+    return out[1]
+
+# Start serve() in raybox_peripheral.py, via the raw REPL:
+def start_stream_steps():
+    yield b'serve()\x04'
+    yield [b'OK']
+    r = yield [b'S', b'\x04']
+    if r[0] != b'S':
+        err = yield [b'\x04>']
+        raise Exception(f'serve() failed to start: {err}')
+
+# Stop serve(), which then finishes the raw REPL command that started it:
+def stop_stream_steps():
+    yield b'X'
+    yield [b'\x04']
+    r = yield [b'\x04>']
+    if len(r[1]) != 0:
+        raise Exception(f'Got unexpected response from serve(): {r[1]}')
+
+# Wait for the ack of the oldest packet in 'in_flight' (serve() acks them in order), and remove it from there.
+# Entries are (packet, when it was sent), which is returned once it's acked. If it failed, RayboxCommandError
+# is raised for it instead:
+def ack_steps(in_flight):
+    packet, sent = in_flight[0]
+    r = yield [b'K', b'?', b'E']
+    in_flight.popleft()
+    if len(r[1]) != 0:
+        print(f'WARNING: Unexpected data before ack for packet {packet}: {r[1]}')
+    if r[0] == b'?':
+        raise RayboxCommandError(packet, 'serve() did not understand it')
+    elif r[0] == b'E':
+        message = (yield [b'\n'])[1]
+        raise RayboxCommandError(packet, message.decode('utf-8', 'replace'))
+    return (packet, sent)
+
+# Whether check_acks() has another ack to process: either there are more than 'max_in_flight' packets
+# in flight, or some are and there's received data ('pending' bytes) that could be their acks:
+def ack_due(in_flight, max_in_flight, pending):
+    return len(in_flight) > max_in_flight or (len(in_flight) > 0 and pending > 0)
+
+# Get serve()'s vblank scheduler counts:
+def vblank_stats_steps():
+    yield b'V'
+    r = yield [b'\n']
+    if not r[1].startswith(b'V'):
+        raise Exception(f'Expected vblank stats but got: {r[1]}')
+    updated, dropped, idle = r[1][1:].split()
+    return { 'updated': int(updated), 'dropped': int(dropped), 'idle': int(idle) }
+
+# List available COM ports, and return the last one, to use as a default:
+def default_port(owner='MicroPythonInterface'):
+    print("Available COM ports:")
+    ports = sorted(serial.tools.list_ports.comports())
+    if len(ports) == 0:
+        print("NONE! Aborting.")
+        sys.exit(1)
+    for p, desc, hwid in ports:
+        print(f"{p}: {desc} - {hwid}")
+    # Get last port, to use as default:
+    port = ports[-1].device # Can instead find by port.vid/.pid or even port.serial_number
+    print("Using the last port by default")
+    print(f"*** NOTE: If you need to use a specific port, pass it to {owner}(port=...)")
+    return port
 
 # Represents a serial connection to a MicroPython device:
 class MicroPythonInterface:
-    def __init__(self):
-        # List COM ports:
-        print("Available COM ports:")
-        ports = sorted(serial.tools.list_ports.comports())
-        if len(ports) == 0:
-            print("NONE! Aborting.")
-            sys.exit(1)
-        for port, desc, hwid in ports:
-            print(f"{port}: {desc} - {hwid}")
-        # Get last port, to use as default:
-        self.port = ports[-1].device # Can instead find by port.vid/.pid or even port.serial_number
-        print("Using the last port by default")
-        print(f"*** NOTE: If you need to use a specific port, edit {self.__class__.__name__} in {__file__}")
-        #NOTE: baudrate doesn't really make any difference for USB CDC serial devices,
-        # though there is one value (1200) that is a signal to the RP2040 to reset itself.
-        self.conn = serial.Serial(port=self.port, baudrate=9600)
+    # 'port' can be a device name (e.g. COM3 or /dev/ttyACM0) or any pyserial URL.
+    # If not given, the last available COM port is used.
+    # Alternatively, 'conn' can be an already-open serial-like object (e.g. raybox_emulator.EmulatedSerial).
+    def __init__(self, port=None, conn=None):
+        if conn is not None:
+            self.port = getattr(conn, 'port', None) if port is None else port
+            self.conn = conn
+        else:
+            if port is None: port = default_port(self.__class__.__name__)
+            self.port = port
+            #NOTE: baudrate doesn't really make any difference for USB CDC serial devices,
+            # though there is one value (1200) that is a signal to the RP2040 to reset itself.
+            self.conn = serial.serial_for_url(self.port, baudrate=9600)
         self.conn.timeout = 10.0
         self.conn.write_timeout = 10.0
+        self.rx = bytearray() # Received data that await_bytes hasn't consumed yet.
         # self.write = self.conn.write
 
     def write(self, *data):
@@ -47,63 +228,59 @@ class MicroPythonInterface:
     # Await a read of any of a few possible binary strings.
     # If a match is found, a tuple is returned comprising the match, and the data preceeding it.
     # If a timeout occurs before a match is found, then the actual received data is returned.
+    # Data is read in chunks of whatever is already waiting (rather than one byte per read),
+    # so anything received after the match is kept in self.rx for the next call.
     def await_bytes(self, mark, timeout=5.0, exception=None):
-        data = b''
         if type(mark) is not list: mark = [mark]
         old_timeout = self.conn.timeout
         start_time = time.time()
+        scanned = 0 # How much of self.rx has already been searched for the marks.
         try:
             self.conn.timeout = timeout
             while True:
+                r = take_marker(self.rx, mark, scanned)
+                if r is not None: return r
+                scanned = len(self.rx)
                 if time.time() - start_time > timeout:
                     # Timeout while streaming data, waiting for end...
                     break
-                # Read one byte at a time until we get the string we want:
-                r = self.conn.read()
+                # Block for at least 1 byte, but take everything else that's already waiting too:
+                r = self.conn.read(max(1, self.conn.in_waiting))
                 if len(r) == 0: break
-                data += r
-                for m in mark:
-                    n = -len(m)
-                    if data[n:] == m: return (m, data[:n])
+                self.rx += r
             # breakpoint()
-            print(f'WARNING: Timeout waiting for {mark}. Read buffer is {len(data)} byte(s)')
+            print(f'WARNING: Timeout waiting for {mark}. Read buffer is {len(self.rx)} byte(s)')
             if exception is not None: raise exception
             return None
         finally:
             self.conn.timeout = old_timeout
 
+    # Carry out one of the *_steps() conversations above, and return its result:
+    def run_steps(self, steps):
+        r = None
+        try:
+            while True:
+                step = steps.send(r)
+                if type(step) is list:
+                    r = self.await_bytes(step, exception=Exception(f'Did not receive any of {step}'))
+                else:
+                    self.write(step)
+                    r = None
+        except StopIteration as e:
+            return e.value
+
     def exit_raw_mode(self):
-        self.write(b'\x02') # Send CTRL+B
-        r = self.await_bytes(b'>>> ')
-        if type(r) is not tuple:
-            raise Exception(f'Expected >>> prompt but got: {r}')
+        self.run_steps(exit_raw_mode_steps())
     
     def enter_raw_mode(self):
-        self.exit_raw_mode()
-        self.write(b'\x01') # Send CTRL+A
-        r = self.await_bytes([
-            b'\nraw REPL; CTRL-B to exit\n>',
-            b'\r\nraw REPL; CTRL-B to exit\r\n>'
-        ])
-        if type(r) is not tuple:
-            raise Exception(f'Expected raw REPL welcome but got: {r}')
+        self.run_steps(enter_raw_mode_steps())
 
     def raw_exec(self, data, decode_response='utf-8'):
-        self.write(data, b'\x04')
-        # Expect acknowledgement of CTRL+D:
-        self.await_bytes(b'OK', exception=Exception('Did not receive OK'))
-        # Expect first EOT to mark start of response:
-        out = self.await_bytes(b'\x04', exception=Exception('Did not receive first EOT'))
-        # Wait until the next EOT to mark the end of the response:
-        r = self.await_bytes(b'\x04>')
-        if type(r) is not tuple:
-            raise Exception(f'Expected 2nd EOT and > prompt but got: {r}')
-        if len(r[1]) != 0:
-            raise Exception(f'Got unexpected response to [{data}] from raw_exec: {r[1]}')
+        out = self.run_steps(raw_exec_steps(data))
         if decode_response is None:
-            return out[1]
+            return out
         else:
-            return out[1].decode(decode_response)
+            return out.decode(decode_response)
     
     def exec(self, data):
         return self.raw_exec(data, 'ascii').strip()
@@ -111,8 +288,11 @@ class MicroPythonInterface:
 
 # Represents a TT04 board running MicroPython:
 class TT04(MicroPythonInterface):
-    def __init__(self):
-        super().__init__()
+    def __init__(self, port=None, conn=None):
+        super().__init__(port, conn)
+        # If a previous session left serve() (from raybox_peripheral.py) running, stop it. Otherwise, this is
+        # just junk typed in at the REPL, which the following CTRL+C clears:
+        self.write(RESYNC)
         # Send CTRL+C twice to stop any running program:
         self.write(b'\x03\x03')
         print('Entering raw mode...')
@@ -161,23 +341,137 @@ class RayboxZeroController(TT04):
     UI_INC_PY   = 5
     UI_REG      = 6
 
-    def __init__(self):
-        super().__init__()
+    def __init__(self, port=None, conn=None):
+        self.streaming = False
+        self.pipeline_depth = PIPELINE_DEPTH
+        self.in_flight = collections.deque() # Stream packets sent (with time.perf_counter_ns() when), but not yet acknowledged.
+        self.on_ack = None # If set, called with (packet, when it was sent) as each stream packet's ack is processed.
+        self.regs = {}  # Last value sent to each register (by REG_CMDS name).
+        self.dirty = {} # Register writes queued by queue_reg(), waiting for commit().
+        self.stats = collections.Counter()
+        self.last_pov = None # Last POV sent (as an int), and when:
+        self.last_pov_time = 0.0
+        self.vblank_sync = False
+        super().__init__(port, conn)
         self.enter_raw_mode()
-        print(self.reset_tt_pin_modes())
-        self.set_ui_in(0b0000_1000)
-        self.select_project('tt_um_algofoogle_raybox_zero')
-        print(self.exec(f'machine.freq({int(MACHINE_FREQ)})'))
-        print(self.set_clock_hz(CLOCK_SPEED))
-        self.reset_project()
         peripheral_code_path = os.path.join(
             os.path.dirname(os.path.abspath(__file__)),
             PATH_TO_RAYBOX_PERIPHERAL_CODE
         )
         remote_api_code = Path(peripheral_code_path).read_text()
-        print(self.exec(remote_api_code))
+        setup = expected_device_state(remote_api_code)
+        code_hash = setup[-1]
+        if FAST_RECONNECT and self.device_state() == setup:
+            print(f'Board is already set up, with the same raybox_peripheral.py ({code_hash}); skipping setup and upload')
+            self.set_ui_in(0b0000_1000)
+        else:
+            print(self.reset_tt_pin_modes())
+            self.set_ui_in(0b0000_1000)
+            self.select_project(PROJECT)
+            print(self.exec(f'machine.freq({int(MACHINE_FREQ)})'))
+            print(self.set_clock_hz(CLOCK_SPEED))
+            self.reset_project()
+            # Pin modes have been reset, so the peripheral code has to set them up again either way:
+            if USE_MPY and self.upload_mpy(peripheral_code_path):
+                print(self.exec('import sys;sys.modules.pop("raybox_peripheral",None);from raybox_peripheral import *'))
+            else:
+                print(self.exec(remote_api_code))
+            self.exec(f'RBZ_CODE_HASH={repr(code_hash)}')
+        # An earlier session might have left the vblank IRQ on (or, after a fresh upload, left it calling
+        # the old VblankScheduler), so make sure it's off unless we're about to turn it on again:
+        if not (USE_STREAM and VBLANK_SYNC): self.exec('vblank.enable(False)')
         print(self.exec('print(repr(tt))'))
         print('RP2040 core clock:', self.exec('print(machine.freq())'))
+        if USE_STREAM:
+            self.start_stream()
+            if VBLANK_SYNC: self.set_vblank_sync(True)
+
+    # What the board is actually set up with (see DEVICE_STATE_QUERY), or None if it can't tell:
+    def device_state(self):
+        return parse_device_state(self.exec(DEVICE_STATE_QUERY))
+
+    # Compile raybox_peripheral.py with mpy-cross and write it to the board's filesystem, so it can be
+    # imported from there (which is quicker than MicroPython compiling the source we send it).
+    # Returns False (so the source should be sent instead) if it can't be compiled:
+    def upload_mpy(self, source_path):
+        with tempfile.TemporaryDirectory() as tmp:
+            mpy_path = os.path.join(tmp, 'raybox_peripheral.mpy')
+            try:
+                subprocess.run([*MPY_CROSS, '-o', mpy_path, source_path], check=True, capture_output=True)
+            except (OSError, subprocess.CalledProcessError) as e:
+                print(f'WARNING: Could not compile {source_path} with {MPY_CROSS[0]} ({e}); sending source instead')
+                return False
+            mpy = Path(mpy_path).read_bytes()
+        self.exec("f=open('raybox_peripheral.mpy','wb')")
+        for p in range(0, len(mpy), 256):
+            self.exec(f'f.write({repr(mpy[p:p+256])})')
+        self.exec('f.close();del f')
+        print(f'Uploaded raybox_peripheral.mpy ({len(mpy)} bytes)')
+        return True
+
+    # Start serve() in raybox_peripheral.py, after which POV/REG updates are sent as binary packets:
+    def start_stream(self):
+        if self.streaming: return
+        self.run_steps(start_stream_steps())
+        self.streaming = True
+
+    # Stop serve(), which then finishes the raw REPL command that started it:
+    def stop_stream(self):
+        if not self.streaming: return
+        self.flush()
+        self.streaming = False
+        self.run_steps(stop_stream_steps())
+
+    # Send a packet to serve() without waiting for its ack, unless that would put
+    # more than pipeline_depth packets in flight:
+    def send_packet(self, packet):
+        self.send_packets([packet])
+
+    # Send several packets to serve() in a single write:
+    def send_packets(self, packets):
+        self.write(b''.join(packets))
+        sent = time.perf_counter_ns()
+        self.in_flight.extend((packet, sent) for packet in packets)
+        self.check_acks(self.pipeline_depth - 1)
+
+    # Turn the RP2040's vblank scheduler (VblankScheduler in raybox_peripheral.py) on or off.
+    # While on, POVs are held on the RP2040 and only the newest is sent, at the start of vblank:
+    def set_vblank_sync(self, state):
+        if not self.streaming:
+            raise Exception('vblank sync needs streaming; see USE_STREAM')
+        self.send_packet(b'B' + (b'\x01' if state else b'\x00'))
+        self.vblank_sync = state
+
+    # Get the RP2040's vblank scheduler counts (since it was loaded), i.e. how many frames got a new POV,
+    # how many POVs were dropped (replaced by a newer one within the same frame), and how many frames had none:
+    def vblank_stats(self):
+        if not self.streaming:
+            updated, dropped, idle = self.exec('print(vblank.stats())').split()
+            return { 'updated': int(updated), 'dropped': int(dropped), 'idle': int(idle) }
+        self.flush()
+        return self.run_steps(vblank_stats_steps())
+
+    # Wait for all packets in flight to be acknowledged:
+    def flush(self):
+        self.check_acks(0)
+
+    # Process acks for packets in flight (which serve() sends in order), first any that have
+    # already arrived, then waiting for more until no more than 'max_in_flight' remain.
+    # If a packet failed, RayboxCommandError is raised for it.
+    def check_acks(self, max_in_flight):
+        while ack_due(self.in_flight, max_in_flight, len(self.rx) + self.conn.in_waiting):
+            acked = self.run_steps(ack_steps(self.in_flight))
+            if self.on_ack is not None: self.on_ack(*acked)
+
+    # Anything other than a POV or REG update has to go via the raw REPL, so pause streaming for it:
+    def raw_exec(self, data, decode_response='utf-8'):
+        if not self.streaming:
+            return super().raw_exec(data, decode_response)
+        self.stop_stream()
+        try:
+            return super().raw_exec(data, decode_response)
+        finally:
+            self.start_stream()
 
     def debug(self, state):
         self.set_ui_bit(self.UI_DEBUG, state)
@@ -186,11 +480,71 @@ class RayboxZeroController(TT04):
         return self.toggle_ui_bit(self.UI_DEBUG)
 
     def set_raw_pov(self, pov):
+        self.pov_sent(pov)
+        if self.streaming:
+            return self.send_packet(pov_packet(pov))
         return self.exec(f'pov.set_raw_pov({repr(pov)})')
     
     def call_peripheral_method(self, interface, method, data):
+        if interface == 'reg' and method in REG_CMDS:
+            # Writing it now supersedes any queued write, and keeps our register cache up to date:
+            self.dirty.pop(method, None)
+            self.regs[method] = int(data)
+            self.stats['reg_sent'] += 1
+            if self.streaming:
+                return self.send_packet(reg_packet(REG_CMDS[method], int(data)))
         return self.exec(f'{interface}.{method}({int(data)})')
 
+    # Queue a register write (e.g. 'sky') to be sent by the next commit(), instead of right away.
+    # Writes of the value a register already has are dropped, and repeated writes to the same
+    # register before the next commit() are merged, so only the last one is sent:
+    def queue_reg(self, name, value):
+        value = int(value) & 0b111111
+        if name in self.dirty:
+            self.stats['reg_merged'] += 1
+        if self.regs.get(name) == value:
+            if self.dirty.pop(name, None) is None: self.stats['reg_redundant'] += 1
+            return
+        self.dirty[name] = value
+
+    # Send all queued register writes, and optionally a POV, as one batch
+    # (i.e. one serial write when streaming, or one raw REPL command otherwise):
+    # If 'pov' is the same as the last POV sent, and POV_HEARTBEAT hasn't elapsed since then,
+    # it isn't sent again (to leave more time for register updates):
+    def commit(self, pov=None):
+        if pov is not None:
+            if self.pov_changed(pov):
+                self.pov_sent(pov)
+            else:
+                self.stats['pov_suppressed'] += 1
+                pov = None
+        regs, self.dirty = self.dirty, {}
+        self.regs.update(regs)
+        self.stats['reg_sent'] += len(regs)
+        if self.streaming:
+            packets = [reg_packet(REG_CMDS[name], value) for name, value in regs.items()]
+            if pov is not None: packets.append(pov_packet(pov))
+            if packets: self.send_packets(packets)
+            return
+        code = [f'reg.{name}({value})' for name, value in regs.items()]
+        if pov is not None: code.append(f'pov.set_raw_pov({repr(pov)})')
+        if code: return self.exec(';'.join(code))
+
+    # True if 'pov' (string of binary digits, or int) differs from the last POV sent,
+    # or the same POV is due to be sent again as a heartbeat:
+    def pov_changed(self, pov):
+        if type(pov) is str: pov = int(pov, 2)
+        if pov != self.last_pov: return True
+        if POV_HEARTBEAT and time.perf_counter() - self.last_pov_time >= POV_HEARTBEAT:
+            self.stats['pov_heartbeat'] += 1
+            return True
+        return False
+
+    def pov_sent(self, pov):
+        self.last_pov = int(pov, 2) if type(pov) is str else pov
+        self.last_pov_time = time.perf_counter()
+        self.stats['pov_sent'] += 1
+
     def set_sky(self, color):
         return self.call_peripheral_method('reg', 'sky', color)
 
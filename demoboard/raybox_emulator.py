@@ -0,0 +1,338 @@
+# Emulated TT04 board, for running and measuring the host side (raybox_controller.py etc.) without hardware,
+# e.g. in CI. EmulatedSerial stands in for the pyserial connection, e.g.:
+#   raybox = RayboxZeroController(conn=EmulatedSerial(latency=0.0005, jitter=0.0002))
+#
+# Behind it, a thread plays the part of MicroPython on the RP2040: it speaks the REPL and raw REPL protocols
+# (CTRL-A/B/C/D, 'OK' and EOT framing), and actually runs the Python code that it is sent (including
+# raybox_peripheral.py, and its serve() loop) under CPython, with stand-ins for 'machine', 'micropython',
+# 'sys.stdin/stdout', the 'tt' demoboard object, etc. SPI writes from raybox_peripheral.py end up in an
+# EmulatedRayboxZero, which decodes them into the POV and registers the ASIC would have, and o_vblank
+# IRQs fire at VBLANK_HZ.
+#
+# Data in each direction is delayed by 'latency' seconds, plus a random 'jitter' (from a seeded RNG, so
+# runs are repeatable), without ever being reordered. Precompiled .mpy code can't be run by the emulator.
+
+import builtins
+import collections
+import io
+import random
+import threading
+import time
+import traceback
+import types
+
+VBLANK_HZ = 60.0 # Rate of emulated o_vblank rising edges.
+
+# One direction of the emulated USB link. Data written to it becomes readable after a delay:
+class DelayedPipe:
+    def __init__(self, latency=0.0, jitter=0.0, rng=None):
+        self.latency = latency
+        self.jitter = jitter
+        self.rng = rng or random.Random(0)
+        self.cond = threading.Condition()
+        self.chunks = collections.deque() # [time when readable, data]
+        self.last = 0.0
+
+    def put(self, data):
+        if len(data) == 0: return
+        with self.cond:
+            t = time.monotonic() + self.latency + (self.rng.uniform(0.0, self.jitter) if self.jitter else 0.0)
+            self.last = t = max(t, self.last) # Never let data overtake what was sent before it.
+            self.chunks.append([t, bytes(data)])
+            self.cond.notify_all()
+
+    # No. of bytes readable now:
+    def available(self):
+        with self.cond:
+            now = time.monotonic()
+            n = 0
+            for t, data in self.chunks:
+                if t > now: break
+                n += len(data)
+            return n
+
+    # Like pyserial's read(): wait until 'size' bytes are readable, or 'timeout' (None means forever) expires,
+    # then return whatever there is (up to 'size' bytes):
+    def get(self, size, timeout=None):
+        deadline = None if timeout is None else time.monotonic() + timeout
+        out = bytearray()
+        with self.cond:
+            while True:
+                now = time.monotonic()
+                while self.chunks and self.chunks[0][0] <= now and len(out) < size:
+                    data = self.chunks[0][1]
+                    take = size - len(out)
+                    out += data[:take]
+                    if take >= len(data):
+                        self.chunks.popleft()
+                    else:
+                        self.chunks[0][1] = data[take:]
+                if len(out) >= size: return bytes(out)
+                wait = None if deadline is None else deadline - now
+                if wait is not None and wait <= 0: return bytes(out)
+                if self.chunks:
+                    ready = self.chunks[0][0] - now
+                    wait = ready if wait is None else min(wait, ready)
+                self.cond.wait(wait)
+
+
+# The raybox-zero ASIC, as far as what its SPI interfaces have been sent:
+class EmulatedRayboxZero:
+    REG_NAMES = {0: 'sky', 1: 'floor', 2: 'leak'}
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.pov = None # 74-bit int.
+        self.regs = {}  # By name (or command number, for those not in REG_NAMES).
+        self.counts = collections.Counter()
+
+    def spi_write(self, interface, data):
+        self.counts[interface] += 1
+        bits = int.from_bytes(data, 'big')
+        if interface == 'pov':
+            self.pov = bits >> (len(data)*8 - 74)
+        else:
+            value = bits >> (len(data)*8 - 10)
+            cmd, data = value >> 6, value & 0b111111
+            self.regs[self.REG_NAMES.get(cmd, cmd)] = data
+
+
+# Stand-ins for MicroPython's 'machine' module, and the TT04 demoboard 'tt' object:
+class FakePin:
+    IN = 0
+    OUT = 1
+    IRQ_RISING = 8
+    IRQ_FALLING = 4
+
+    def __init__(self, name, value=0):
+        self.name = name
+        self.value = value
+        self.mode = FakePin.IN
+        self.handler = None
+        self.raw_pin = self
+
+    def __call__(self, value=None):
+        if value is None: return self.value
+        self.value = int(bool(value))
+
+    def toggle(self):
+        self.value ^= 1
+
+    def irq(self, handler=None, trigger=None):
+        self.handler = handler
+
+    def __repr__(self):
+        return f'<Pin {self.name}>'
+
+class FakeSoftSPI:
+    def __init__(self, baudrate, sck=None, mosi=None, miso=None, asic=None):
+        self.sck = sck
+        self.asic = asic
+
+    def write(self, buf):
+        # Which of raybox-zero's SPI interfaces this is depends on the pins (per RBZSPI in raybox_peripheral.py):
+        self.asic.spi_write('pov' if self.sck.name == 'in0' else 'reg', bytes(buf))
+
+class FakeProject:
+    def __init__(self, tt, name):
+        self.tt = tt
+        self.name = name
+
+    def enable(self):
+        self.tt.project = self.name
+        self.tt.shuttle.enabled = self
+
+class FakeShuttle:
+    def __init__(self, tt):
+        self.tt = tt
+        self.enabled = None
+
+    def __getattr__(self, name):
+        return FakeProject(self.tt, name)
+
+class FakePWM:
+    def __init__(self, hz):
+        self.hz = hz
+
+    def freq(self):
+        return self.hz
+
+class FakeTT:
+    def __init__(self, asic):
+        self.asic = asic
+        for n in range(8):
+            setattr(self, f'in{n}', FakePin(f'in{n}'))
+            setattr(self, f'uio{n}', FakePin(f'uio{n}'))
+        self.mode = None
+        self.project = None
+        self.clock_hz = 0
+        self._clock_pwm = None
+        self.shuttle = FakeShuttle(self)
+
+    @property
+    def input_byte(self):
+        return sum(getattr(self, f'in{n}')() << n for n in range(8))
+
+    @input_byte.setter
+    def input_byte(self, value):
+        for n in range(8): getattr(self, f'in{n}')((value >> n) & 1)
+
+    def clock_project_PWM(self, hz):
+        self.clock_hz = hz
+        self._clock_pwm = FakePWM(hz)
+
+    def clock_project_stop(self):
+        self.clock_hz = 0
+        self._clock_pwm = None
+
+    def reset_project(self, state):
+        if state: self.asic.reset()
+
+    def __repr__(self):
+        return f'<DemoBoard (emulated) as {self.mode}, project {self.project}, clock {self.clock_hz} Hz>'
+
+class RPMode:
+    SAFE = 'SAFE'
+    ASIC_ON_BOARD = 'ASIC_ON_BOARD'
+    ASIC_RP_CONTROL = 'ASIC_RP_CONTROL'
+
+
+# MicroPython on the RP2040, running in its own thread:
+class EmulatedTT04:
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        rng = random.Random(seed)
+        self.to_device = DelayedPipe(latency, jitter, rng)
+        self.to_host = DelayedPipe(latency, jitter, rng)
+        self.asic = EmulatedRayboxZero()
+        self.tt = FakeTT(self.asic)
+        self.kbd_intr = 3
+        self.freq = 125_000_000
+        self.next_vblank = time.monotonic()
+        self.files = {} # Emulated filesystem: name -> bytes.
+        self.globals = self.make_globals()
+        self.thread = threading.Thread(target=self.run, name='emulated-tt04', daemon=True)
+        self.thread.start()
+
+    def out(self, data):
+        self.to_host.put(data.encode('utf-8') if type(data) is str else data)
+
+    # Read exactly 'size' bytes from the host, running o_vblank IRQ handlers whenever they're due in the meantime
+    # (as MicroPython runs scheduled IRQ handlers while it waits for input):
+    def read(self, size):
+        data = bytearray()
+        while len(data) < size:
+            now = time.monotonic()
+            if now >= self.next_vblank:
+                self.next_vblank = max(self.next_vblank + 1.0/VBLANK_HZ, now)
+                if self.tt.uio1.handler is not None: self.tt.uio1.handler(self.tt.uio1)
+            data += self.to_device.get(size - len(data), self.next_vblank - now)
+            if self.kbd_intr == 3 and 3 in data and self.executing:
+                raise KeyboardInterrupt
+        return bytes(data)
+
+    def make_globals(self):
+        device = self
+        class Stdin:
+            def read(self, size=1):     return device.read(size)
+            def readinto(self, buf):    buf[:] = device.read(len(buf)); return len(buf)
+        class Stdout:
+            def write(self, data):      device.out(bytes(data)); return len(data)
+        sys = types.SimpleNamespace(
+            stdin=types.SimpleNamespace(buffer=Stdin()),
+            stdout=types.SimpleNamespace(buffer=Stdout()),
+            modules={},
+        )
+        micropython = types.SimpleNamespace(kbd_intr=lambda c: setattr(device, 'kbd_intr', c))
+        machine = types.SimpleNamespace(
+            Pin=FakePin,
+            SoftSPI=lambda baudrate, sck=None, mosi=None, miso=None: FakeSoftSPI(baudrate, sck, mosi, miso, device.asic),
+            freq=lambda hz=None: device.freq if hz is None else setattr(device, 'freq', hz),
+            disable_irq=lambda: 0,
+            enable_irq=lambda state: None,
+        )
+        modules = {'sys': sys, 'micropython': micropython, 'machine': machine, 'time': time, 'math': __import__('math')}
+        def device_import(name, globals=None, locals=None, fromlist=(), level=0):
+            if name in modules: return modules[name]
+            raise ImportError(f"no module named '{name}'")
+        def device_print(*args, sep=' ', end='\n', file=None):
+            device.out((sep.join(str(a) for a in args) + end).replace('\n', '\r\n'))
+        def device_open(name, mode='r'):
+            if 'w' in mode:
+                f = io.BytesIO()
+                f.close = lambda: device.files.__setitem__(name, f.getvalue())
+                return f
+            return io.BytesIO(device.files[name])
+        return {
+            '__name__': '__main__',
+            '__builtins__': dict(vars(builtins), __import__=device_import, print=device_print, open=device_open),
+            'tt': self.tt,
+            'RPMode': RPMode,
+            'machine': machine,
+        }
+
+    # Run some code as the raw REPL does, returning any error message:
+    def execute(self, code):
+        self.executing = True
+        try:
+            exec(compile(code.decode('utf-8'), '<stdin>', 'exec'), self.globals)
+            return b''
+        except BaseException as e:
+            message = 'Traceback (most recent call last):\n  File "<stdin>"\n' + ''.join(traceback.format_exception_only(type(e), e))
+            return message.replace('\n', '\r\n').encode('utf-8')
+        finally:
+            self.executing = False
+            self.kbd_intr = 3
+
+    def run(self):
+        self.executing = False
+        raw = False
+        line = bytearray()
+        while True:
+            c = self.read(1)
+            if c == b'\x01': # CTRL+A: Enter raw REPL.
+                raw = True
+                line.clear()
+                self.out(b'\r\nraw REPL; CTRL-B to exit\r\n>')
+            elif c == b'\x02': # CTRL+B: Back to the normal REPL.
+                raw = False
+                line.clear()
+                self.out(b'\r\nMicroPython (emulated TT04)\r\n>>> ')
+            elif c == b'\x03': # CTRL+C: Clear the line.
+                line.clear()
+                if not raw: self.out(b'\r\n>>> ')
+            elif c == b'\x04' and raw: # CTRL+D: Run the code.
+                self.out(b'OK')
+                error = self.execute(bytes(line))
+                line.clear()
+                self.out(b'\x04' + error + b'\x04>')
+            elif raw:
+                line += c
+
+
+# Host side of the emulated USB serial link, with as much of the pyserial API as the controllers use:
+class EmulatedSerial:
+    def __init__(self, latency=0.0, jitter=0.0, seed=0):
+        self.port = f'emulated (latency {latency*1000:g} ms, jitter {jitter*1000:g} ms)'
+        self.device = EmulatedTT04(latency, jitter, seed)
+        self.timeout = None
+        self.write_timeout = None
+        self.is_open = True
+
+    @property
+    def in_waiting(self):
+        return self.device.to_host.available()
+
+    def read(self, size=1):
+        return self.device.to_host.get(size, self.timeout)
+
+    def write(self, data):
+        self.device.to_device.put(data)
+        return len(data)
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.is_open = False
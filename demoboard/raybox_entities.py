@@ -0,0 +1,160 @@
+# Lots of moving things (NPCs, projectiles, etc.) for raybox_game.py, with their state kept in NumPy arrays
+# (one element per entity) rather than one Python object each, so that moving all of them, colliding them
+# with the map, and converting their positions to fixed-point are each a handful of array operations:
+#
+#   entities = Entities()
+#   i = entities.spawn(x, y, vx, vy, size=0.1, ttl=2.0, on_hit=HIT_DIE)
+#   entities.step(dt, walls) # 'walls' is a bool array, indexed [x, y], e.g. RBZMap.walls.
+#
+# Collision is against the map grid only (not between entities), one axis at a time, and an entity's size
+# must be under 1.0. Moves bigger than a quarter of an entity's size are split into smaller steps (for all
+# entities at once) so that nothing can skip through a wall.
+#
+# Run it directly to measure how long a step takes for a given number of entities, e.g.:
+#   python3 raybox_entities.py --count 1000
+
+import math
+import numpy as np
+
+# What happens to an entity when it hits a wall:
+HIT_SLIDE   = 0 # Stop moving on that axis (i.e. slide along the wall).
+HIT_BOUNCE  = 1 # Reverse direction on that axis.
+HIT_DIE     = 2 # Disappear (e.g. projectiles).
+
+MAX_SUBSTEPS = 16 # Limit on steps per step() (so a huge dt can't stall the game), after which things may tunnel.
+
+# Convert floats to raybox-zero fixed-point integers, the same way as Player.float_to_fixed in raybox_game.py
+# (i.e. truncate, then keep the low bits as two's complement):
+FIXED_FORMATS = { 'UQ6.9': (9, 0x7FFF), 'SQ2.9': (9, 0x7FF), 'Q12.12': (12, 0xFFFFFF) }
+def to_fixed(values, q: str = 'UQ6.9'):
+    if q not in FIXED_FORMATS:
+        raise Exception(f"Unsupported fixed-point format: {q}")
+    frac, mask = FIXED_FORMATS[q]
+    return np.trunc(np.asarray(values) * 2.0**frac).astype(np.int64) & mask
+
+class Entities:
+    def __init__(self, capacity: int = 256):
+        self.count = 0      # Slots in use so far (alive or dead), i.e. only [:count] of each array matters.
+        self.free = []      # Dead slots below 'count', for reuse.
+        self.allocate(capacity)
+
+    # (Re)allocate the arrays with room for 'capacity' entities, keeping any existing ones:
+    def allocate(self, capacity: int):
+        def grow(name, dtype, fill=0):
+            a = np.full(capacity, fill, dtype=dtype)
+            if hasattr(self, name): a[:self.count] = getattr(self, name)[:self.count]
+            setattr(self, name, a)
+        grow('x',       np.float64)
+        grow('y',       np.float64)
+        grow('vx',      np.float64) # Velocity, in map units per second.
+        grow('vy',      np.float64)
+        grow('size',    np.float64) # Width (i.e. 2x radius) in map units.
+        grow('angle',   np.float64)
+        grow('ttl',     np.float64, np.inf) # Seconds left to live.
+        grow('kind',    np.uint8)   # For the game to tell its entities apart; not used here.
+        grow('on_hit',  np.uint8)
+        grow('alive',   bool)
+        self.capacity = capacity
+
+    def spawn(self, x, y, vx=0.0, vy=0.0, size=0.5, angle=0.0, ttl=np.inf, kind=0, on_hit=HIT_SLIDE) -> int:
+        if self.free:
+            i = self.free.pop()
+        else:
+            if self.count == self.capacity: self.allocate(self.capacity*2)
+            i = self.count
+            self.count += 1
+        self.x[i], self.y[i], self.vx[i], self.vy[i] = x, y, vx, vy
+        self.size[i], self.angle[i], self.ttl[i] = size, angle, ttl
+        self.kind[i], self.on_hit[i], self.alive[i] = kind, on_hit, True
+        return i
+
+    def kill(self, i: int):
+        if self.alive[i]:
+            self.alive[i] = False
+            self.free.append(i)
+
+    # Indices of all living entities:
+    def living(self):
+        return np.flatnonzero(self.alive[:self.count])
+
+    def __len__(self):
+        return self.count - len(self.free)
+
+    # Advance everything by 'dt' seconds, colliding with 'walls' (if given):
+    def step(self, dt: float, walls=None):
+        i = self.living()
+        if len(i) == 0: return
+        self.ttl[i] -= dt
+        for j in i[self.ttl[i] <= 0]: self.kill(j)
+        i = i[self.ttl[i] > 0]
+        if walls is None:
+            self.x[i] += self.vx[i]*dt
+            self.y[i] += self.vy[i]*dt
+            return
+        travel = np.maximum(np.abs(self.vx[i]), np.abs(self.vy[i])) * dt / (self.size[i]/4.0)
+        steps = min(MAX_SUBSTEPS, max(1, math.ceil(travel.max()))) if len(i) else 1
+        for _ in range(steps):
+            i = self.move_axis(i, self.x, self.y, self.vx, dt/steps, walls)
+            i = self.move_axis(i, self.y, self.x, self.vy, dt/steps, walls.T)
+        # (Moving one axis at a time means a diagonal move can't squeeze between two walls that touch at a corner.)
+
+    # Move entities 'i' along one axis ('pos', with velocity 'v') for 'dt', where 'other' is their position
+    # on the other axis, and 'walls' is indexed [this axis, other axis]. Returns those still alive:
+    def move_axis(self, i, pos, other, v, dt, walls):
+        cols, rows = walls.shape
+        r = self.size[i]/2.0
+        old = pos[i]
+        new = old + v[i]*dt
+        forward = v[i] > 0
+        lead = np.floor(np.where(forward, new + r, new - r)).astype(np.int64) # Cell our leading edge is in.
+        # Cells we span on the other axis (not counting one that our edge is only touching):
+        o = other[i]
+        hit = (
+            walls[lead % cols, np.floor(o - r).astype(np.int64) % rows] |
+            walls[lead % cols, (np.ceil(o + r) - 1).astype(np.int64) % rows]
+        ) & (v[i] != 0)
+        # Stop at the wall, just touching it (but never going back, or further than we were moving):
+        stop = np.clip(np.where(forward, lead - r, lead + 1 + r), np.minimum(old, new), np.maximum(old, new))
+        pos[i] = np.where(hit, stop, new)
+        if hit.any():
+            action = self.on_hit[i]
+            v[i[hit & (action == HIT_SLIDE)]] = 0.0
+            bounce = i[hit & (action == HIT_BOUNCE)]
+            v[bounce] = -v[bounce]
+            dead = hit & (action == HIT_DIE)
+            for j in i[dead]: self.kill(j)
+            i = i[~dead]
+        return i
+
+    # Positions of living entities as raybox-zero fixed-point (UQ6.9) integers:
+    def fixed(self):
+        i = self.living()
+        return to_fixed(self.x[i], 'UQ6.9'), to_fixed(self.y[i], 'UQ6.9')
+
+
+if __name__ == '__main__':
+    import argparse
+    import time
+    from raybox_model import map_rom
+    parser = argparse.ArgumentParser(description='Time Entities.step() with a given number of entities bouncing around the map')
+    parser.add_argument('--count', type=int, default=500, help='No. of entities (half NPCs, half projectiles)')
+    parser.add_argument('--steps', type=int, default=200, help='No. of steps to time')
+    parser.add_argument('--dt', type=float, default=0.008, help='Seconds per step (default: one raybox_game.py TICK)')
+    args = parser.parse_args()
+    walls = np.array(map_rom(16, 16)).reshape(16, 16) != 0
+    free = np.argwhere(~walls)
+    rng = np.random.default_rng(0)
+    entities = Entities()
+    for n in range(args.count):
+        cx, cy = free[rng.integers(len(free))]
+        a = rng.uniform(0, 2*math.pi)
+        npc = n % 2 == 0
+        speed, size = (2.0, 0.5) if npc else (8.0, 0.1)
+        entities.spawn(cx+0.5, cy+0.5, speed*math.cos(a), speed*math.sin(a), size, a, kind=0 if npc else 1, on_hit=HIT_BOUNCE)
+    start = time.perf_counter()
+    for _ in range(args.steps):
+        entities.step(args.dt, walls)
+        entities.fixed()
+    elapsed = (time.perf_counter() - start) / args.steps
+    assert not walls[entities.x[:entities.count].astype(int) % 16, entities.y[:entities.count].astype(int) % 16].any()
+    print(f'{len(entities)} entities: {elapsed*1000:.3f} ms per step (incl. fixed-point conversion)')
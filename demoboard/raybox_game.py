@@ -7,13 +7,18 @@ import time
 import os
 import math
 import re
+import numpy as np
 from raybox_controller import RayboxZeroController
+from raybox_emulator import EmulatedSerial
+from raybox_entities import Entities, HIT_DIE
+from raybox_model import map_rom, rgb222_to_rgb888, RayboxZeroModel, WIDTH as RBZ_WIDTH, HEIGHT as RBZ_HEIGHT
+from raybox_transport import RayboxTransport
 
 # Main input functions:
 # - WASD keys move
 # - Mouse left/right motion rotates
 # - Left/right keyboard arrows rotate also (as do Q/E)
-# - Mouse left button 'shoots' (just a visual effect)
+# - Mouse left button shoots (a visual effect, plus a projectile on the map preview)
 
 # Numpad:
 #     9: sky_color++
@@ -45,6 +50,7 @@ from raybox_controller import RayboxZeroController
 #     F11: Toggle system pause
 #     R: Reset game state
 #     `: Toggle vectors debug overlay
+#     V: Toggle virtual view (what raybox-zero should be showing, per raybox_model.py)
 
 DEBUG               = False # Print debug info for each update?
 DISABLE_COLLISIONS  = False # Disable collision detection?
@@ -54,11 +60,21 @@ RBZ_MAP_SCALE       = 32.0  # Controls how big our map preview is.
 PLAYER_SIZE         = 0.55  # min=0.28 (less will expose overflows). 0.6875 is same as Wolf3D? 0.55 fees 'right'
 ROTATE_MOUSE        = False # If True, use mouse Y (up/down) instead of X.
 FLIPPED             = False # If True, assume monitor is rotated clockwise rather than CCW.
+USE_TRANSPORT       = True  # If True, a worker thread talks to the board, so the game loop never waits on it.
+PROJECTILE_SPEED    = 8.0   # Map units per second.
+PROJECTILE_SIZE     = 0.1   # Map units.
+PROJECTILE_TTL      = 2.0   # Seconds before a projectile that hasn't hit anything disappears.
+VIRTUAL_VIEW        = False # If True, start with the virtual view showing (beside the map preview).
+EMULATE_BOARD       = False # If True, run without a board, using raybox_emulator.py instead (and show the virtual view).
 
 # This is the size of the game map window that we display on the PC:
 SCREEN_W            = 900
 SCREEN_H            = 700
 WINDOW_TITLE        = 'raybox_game'
+# Virtual view is the ASIC's portrait display (RBZ_HEIGHT lines of RBZ_WIDTH pixels) turned upright, scaled to our height:
+VIEW_H              = SCREEN_H
+VIEW_W              = SCREEN_H * RBZ_HEIGHT // RBZ_WIDTH
+TEXT_CACHE_SIZE     = 256   # Max. rendered text surfaces to keep (e.g. vector readouts change every frame while moving).
 
 # Nanoseconds to milliseconds:
 NSMS        = 1_000_000
@@ -68,25 +84,70 @@ NSMS        = 1_000_000
 # it's possible to schedule at least 2 updates per frame:
 TICK        = 8_000_000
 
+# Rates of the other stages of the main loop (also in nanoseconds), which are scheduled independently,
+# with the main loop sleeping in between rather than spinning:
+INPUT_PERIOD    = 4_000_000     # Poll keyboard/mouse state (events wake us up straight away, regardless).
+SIM_PERIOD      = 4_000_000     # Update the player from inputs.
+PREVIEW_PERIOD  = 16_666_667    # Redraw our preview window (~60fps).
+SPIN_NS         =   200_000     # Busy-wait only for this last bit before each deadline, since OS sleeps aren't that precise.
+
 # Set working dir to wherever this script is located:
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
 # Create our interface that talks to MicroPython on the TT04 demo board,
 # for loading and controlling the raybox-zero project:
-raybox = RayboxZeroController()
+raybox = RayboxZeroController(conn=EmulatedSerial() if EMULATE_BOARD else None)
+# Game updates go to 'device', which is either a RayboxTransport (that does all the actual talking to raybox
+# from its own thread) or raybox itself:
+device = RayboxTransport(raybox) if USE_TRANSPORT else raybox
+
+# Software model of raybox-zero for the virtual view, which gets all the same updates as the board:
+view_model = RayboxZeroModel(cols=RBZ_MAP_COLS, rows=RBZ_MAP_ROWS)
+view_time = 0 # Time (ns) taken to render the last virtual view frame.
+
+# Passes POV and register updates on to both the board and the virtual view's model:
+class UpdateTee:
+    def __init__(self, *targets):
+        self.targets = targets
+
+    def queue_reg(self, name, value):
+        for t in self.targets: t.queue_reg(name, value)
+
+    def commit(self, pov=None):
+        for t in self.targets: t.commit(pov)
+
+updates = UpdateTee(device, view_model)
 
 # Set up a Pygame window.
 pygame.init()
 pygame.display.set_caption(WINDOW_TITLE)
-screen = pygame.display.set_mode((SCREEN_W,SCREEN_H))
+
+# Show (or hide) the virtual view, widening (or narrowing) the window to suit:
+def show_view(state: bool):
+    global screen, view_enabled
+    view_enabled = state
+    screen = pygame.display.set_mode((SCREEN_W + (VIEW_W if state else 0), SCREEN_H))
+
+show_view(VIRTUAL_VIEW or EMULATE_BOARD)
+# The model renders RGB222 values, so the view surface is 8-bit with a palette of all 64 of them.
+# Its width is the ASIC's lines, and height is pixels along each line:
+view_surface = pygame.Surface((RBZ_HEIGHT, RBZ_WIDTH), depth=8)
+view_surface.set_palette([tuple(c) for c in rgb222_to_rgb888(np.arange(64, dtype=np.uint8)).tolist()])
 
 # Load font:
 font = pygame.font.Font("font-cousine/Cousine-Regular.ttf", 12)
-info_text = font.render(
-    "M: Capture/release mouse",
-    True,
-    (255,255,0),
-)
+
+# Rendered text, by (string, colour), since most of what we display is the same from one frame to the next:
+text_cache = {}
+def text_surface(text: str, color=(255,255,255)):
+    key = (text, color)
+    surface = text_cache.get(key)
+    if surface is None:
+        if len(text_cache) >= TEXT_CACHE_SIZE: text_cache.clear()
+        surface = text_cache[key] = font.render(text, True, color)
+    return surface
+
+info_text = text_surface("M: Capture/release mouse", (255,255,0))
 
 # Call capture_mouse(True) (or False) at least once to set its internal state.
 # Then you can call capture_mouse() to toggle the capture state (which it will return after changing)
@@ -122,7 +183,7 @@ start = timer = ts()
 running         = True
 tick_counter    = 0     # No. of ticks that have elapsed since we started timing.
 hit_counter     = 0     # No. of times we hit our timing target.
-loop_counter    = 0     # No. of iterations of our loop since last timing hit.
+loop_counter    = 0     # No. of iterations (i.e. wakeups) of our loop since last timing hit.
 event_counter   = 0
 pause           = False
 
@@ -134,6 +195,10 @@ max_delta       = 0     # Target is 'TICK', but so long as it's less than TICK*1
 sum_deltas      = 0     # Used to produce an average of time deltas.
 
 
+# Cells in the 3x3 block around (and including) a map cell, as (dx,dy), in the bit order of RBZMap.neighbours():
+NEIGHBOURS = [(-1,-1), (0,-1), (1,-1), (-1,0), (0,0), (1,0), (-1,1), (0,1), (1,1)]
+N_TL, N_T, N_TR, N_L, N_C, N_R, N_BL, N_B, N_BR = [1 << n for n in range(9)]
+
 # This holds the state of the game environment:
 class RBZMap:
     FLASH_STEPS = [
@@ -170,52 +235,18 @@ class RBZMap:
         self.flash_step = 0
         # Initialise map to our bitwise pattern per:
         # https://github.com/algofoogle/raybox-zero/blob/main/src/rtl/map_rom.v
-        self.map_data = [0] * (self.map_cols * self.map_rows)
-        w = self.map_cols
-        h = self.map_rows
-        for y in range(h):
-            for x in range(w):
-
-                left_right_borders = (x == 0) | (x == (w - 1))
-                top_bottom_borders = (y == 0) | (y == (h - 1))
-
-                low_3_bits_match = ((y & 0b111)^0b111 == (x & 0b111))
-                bit_3_of_y_and_x_are_zero = ((y & 0b1000) == 0) & ((x & 0b1000) == 0)
-
-                expression1 = low_3_bits_match & bit_3_of_y_and_x_are_zero
-
-                bitwise_ops = ((((y & 0b10) ^ ( (x & 0b100) >> 1)))>>1) ^ ((y & 1) & ((x >> 1) & 1))
-                expression2 = bitwise_ops & ((y & 0b100)>>2) & ((x & 0b10)>>1)
-                expression3 = ((y & 1)^1) & ((x & 1)^1)
-
-                expression4 = (expression2 | expression3)
-                bits_2_match = ((y & 0b100)>>2) ^ ~((x & 0b100)>>2)
-
-                c = (
-                    (left_right_borders) |
-                    (top_bottom_borders) |
-                    (expression1) |
-                    (expression4 & bits_2_match)
-                )
-
-                b0 = 0b01 if c else 0b00
-
-                f1 = (x>>3) & 1; f2 = (x>>2) & 1; f3 = (x>>1) & 1; f4 = x & 1
-                a6 = (y>>3) & 1; b6 = (y>>2) & 1; c6 = (y>>1) & 1; d6 = y & 1
-                d = 1 if (x==8 and y==10) else 0
-                c = ((((f3^d6) & (f2^a6)) & (f4^b6)) & (f1^c6)) | d
-                b1 = 0b10 if c else 0b00
-
-                self.cell(x,y,b1|b0)
+        self.map_data = map_rom(self.map_cols, self.map_rows)
+        self.build_collision()
         self.generate_map_surface()
 
     def env_flash(self, start=False):
+        # Flash colours are queued (and sent with the next POV) without changing sky_color/floor_color:
         if FLIPPED:
-            sky = self.raybox.set_floor
-            floor = self.raybox.set_sky
+            sky = lambda c: self.raybox.queue_reg('floor', c)
+            floor = lambda c: self.raybox.queue_reg('sky', c)
         else:
-            sky = self.raybox.set_sky
-            floor = self.raybox.set_floor
+            sky = lambda c: self.raybox.queue_reg('sky', c)
+            floor = lambda c: self.raybox.queue_reg('floor', c)
         count = len(RBZMap.FLASH_STEPS)
         if start:
             self.flash_step = count
@@ -238,12 +269,13 @@ class RBZMap:
         return lut[color]
 
     # This gives us the properties 'sky_color', 'floor_color', and 'leak'
-    # which automatically update their respective register values in our raybox peripheral:
+    # which automatically queue updates of their respective register values in our raybox peripheral
+    # (sent along with the next POV, so a burst of changes within one tick only costs one write):
     def __setattr__(self, name, value):
         if name in ['sky_color', 'floor_color', 'leak']:
             value %= 64 # Range is 0..63
             self.__dict__[name] = value
-            self.raybox.call_peripheral_method('reg', name.split('_')[0], value)
+            self.raybox.queue_reg(name.split('_')[0], value)
         else:
             super().__setattr__(name, value)
 
@@ -265,18 +297,15 @@ class RBZMap:
         ss = self.screen_scale
         mx = (self.map_cols)*ss
         my = (self.map_rows)*ss
-        if FLIPPED:
-            flipper = -1
-            offset = mx-ss
-        else:
-            flipper = 1
-            offset = 0
-        surf = self.map_surface = pygame.Surface( (mx,my) )
+        # Draw one pixel per cell, then scale it up (which is much quicker than drawing every cell at full size):
+        cells = pygame.Surface( (self.map_cols, self.map_rows) )
         for y in range(self.map_rows):
             for x in range(self.map_cols):
                 c = self.cell(x, y)
                 if c is not None:
-                    pygame.draw.rect(surf, self.cell_color_lut(c), pygame.rect.Rect(offset+x*ss*flipper,y*ss,ss,ss))
+                    cells.set_at((x, y), self.cell_color_lut(c))
+        if FLIPPED: cells = pygame.transform.flip(cells, True, False)
+        self.map_surface = pygame.transform.scale(cells, (int(mx), int(my)))
 
     # Convert map X/Y position to screen coordinates,
     # with the centre of the map (nominally 7.5,7.5) at the centre of the screen:
@@ -290,6 +319,15 @@ class RBZMap:
             int(self.screen_height/2.0 + ss*(y-mcy)),
         )
 
+    # Same as xy_screen, for arrays of positions:
+    def xy_screen_array(self, x, y):
+        flipper = -1 if FLIPPED else 1
+        ss = self.screen_scale
+        return (
+            (self.screen_width/2.0 + flipper*ss*(x-self.map_width/2.0)).astype(np.int32),
+            (self.screen_height/2.0 + ss*(y-self.map_height/2.0)).astype(np.int32),
+        )
+
     # Look up (and optionally set) the contents of a given map cell:
     def cell(self, x: int, y: int, set: int = None):
         #NOTE: Map data is stored as Y/X instead of X/Y:
@@ -298,7 +336,26 @@ class RBZMap:
             return None if c == 0 else c
         else:
             self.map_data[x*self.map_rows + y] = set
+            self.build_collision()
             return set
+
+    # Rebuild the collision field: for each cell, a bitmask (N_* bits) of which cells in the 3x3 block around it
+    # are walls, so a collision check needs just one lookup. Like the ASIC, the map wraps around at its edges:
+    def build_collision(self):
+        cols, rows = self.map_cols, self.map_rows
+        self.collision = [0] * (cols*rows)
+        for x in range(cols):
+            for y in range(rows):
+                mask = 0
+                for bit, (dx, dy) in enumerate(NEIGHBOURS):
+                    if self.map_data[((x+dx) % cols)*rows + (y+dy) % rows]: mask |= 1 << bit
+                self.collision[x*rows + y] = mask
+        # Also as a bool array indexed [x, y], for raybox_entities.py:
+        self.walls = np.array(self.map_data, dtype=bool).reshape(cols, rows)
+
+    # Look up which cells around (and including) a given cell are walls, as N_* bits:
+    def neighbours(self, x: int, y: int) -> int:
+        return self.collision[(x % self.map_cols)*self.map_rows + (y % self.map_rows)]
     
     # Retrieve the rectangle screen coordinates represenvation of a given map cell:
     def cell_screen_rect(self, x: int, y: int):
@@ -323,17 +380,113 @@ class Actor:
         self.run_scaler = 5.0/3.0
         self.crawl_scaler = 1.0/6.0
     
-    def render(self, map: RBZMap, screen):
+    # Body square, centred on our position on the on-screen map:
+    def body_rect(self, map: RBZMap):
         flipper = 1 # -1 if FLIPPED else 1
         s = map.screen_scale
-        r = pygame.Rect(0, 0, s*self.size, s*self.size) # Body square.
-        (cx,cy) = map.xy_screen(self.x * flipper, self.y) # Position.
-        r.center = (cx, cy)
+        r = pygame.Rect(0, 0, s*self.size, s*self.size)
+        r.center = map.xy_screen(self.x * flipper, self.y)
+        return r
+
+    # Screen area that render() draws in:
+    def screen_rect(self, map: RBZMap):
+        return self.body_rect(map)
+
+    def render(self, map: RBZMap, screen):
+        r = self.body_rect(map)
         pygame.draw.rect(screen, self.color, r) # Draw body square centred on position.
         # s = map.screen_scale #-1.0
         # pygame.draw.line(screen, (255,255,255), (cx,cy-s/2.0), (cx,cy+s/2.0))
         # pygame.draw.line(screen, (255,255,255), (cx-s/2.0,cy), (cx+s/2.0,cy))
-        return (cx,cy)
+        return r.center
+
+    # Apply a motion vector to the actor position, optionally using
+    # collision detection (clipping):
+    def move(self, x: float, y: float, clip_map: RBZMap = None):
+        if clip_map is None:
+            self.x += x
+            self.y += y
+        else:
+            (self.x, self.y) = self.try_move(x, y, clip_map)
+
+    # Determine new position by attempting to move on the vector (x,y) while respecting collision detection.
+    # A big move is split into steps of no more than a quarter of our size, so that we can't skip through walls
+    # (or their corners) in a single step. Normal walking speeds are well under this, i.e. just one step:
+    def try_move(self, x: float, y: float, map: RBZMap):
+        if DISABLE_COLLISIONS:
+            return (self.x + x, self.y + y)
+        max_step = self.size/4.0
+        if abs(x) + abs(y) <= max_step:
+            return self.clip_step(self.x, self.y, self.x + x, self.y + y, map)
+        steps = math.ceil(math.hypot(x, y) / max_step)
+        px, py = self.x, self.y
+        for _ in range(steps):
+            (nx, ny) = self.clip_step(px, py, px + x/steps, py + y/steps, map)
+            if (nx, ny) == (px, py): break # Blocked.
+            (px, py) = (nx, ny)
+        return (px, py)
+
+    # Clip a single step from (fx,fy) to (tx,ty) against walls, returning where we end up.
+    # This is basically a reimplementation of:
+    # https://dev.opera.com/articles/3d-games-with-canvas-and-raycasting-part-2/#collision-detection
+    def clip_step(self, fx: float, fy: float, tx: float, ty: float, map: RBZMap):
+        r = self.size / 2.0
+        r2 = r*r
+        # Quantize to map cell coords:
+        bx = int(tx)
+        by = int(ty)
+        n = map.neighbours(bx, by)
+        if n & N_C: return (fx, fy) # Trying to move completely into a blocking cell; stop the move completely.
+        ct = n & N_T # Up 1 cell.
+        cb = n & N_B # Down 1 cell.
+        cl = n & N_L # Left 1 cell.
+        cr = n & N_R # Right 1 cell.
+        if (ct and ty  -by < r): ty = by   + r
+        if (cb and by+1-ty < r): ty = by+1 - r
+        if (cl and tx  -bx < r): tx = bx   + r
+        if (cr and bx+1-tx < r): tx = bx+1 - r
+
+        # is tile to the top-left a wall
+        if n & N_TL and not (ct and cl):
+            dx = tx - bx
+            dy = ty - by
+            if dx * dx + dy * dy < r2:
+                if dx * dx > dy * dy:
+                    tx = bx + r
+                else:
+                    ty = by + r
+
+        # is tile to the top-right a wall
+        if n & N_TR and not (ct and cr):
+            dx = tx - (bx + 1)
+            dy = ty - by
+            if dx * dx + dy * dy < r2:
+                if dx * dx > dy * dy:
+                    tx = bx + 1 - r
+                else:
+                    ty = by + r
+
+        # is tile to the bottom-left a wall
+        if n & N_BL and not (cb and cl):
+            dx = tx - bx
+            dy = ty - (by + 1)
+            if dx * dx + dy * dy < r2:
+                if dx * dx > dy * dy:
+                    tx = bx + r
+                else:
+                    ty = by + 1 - r
+
+        # is tile to the bottom-right a wall
+        if n & N_BR and not (cb and cr):
+            dx = tx - (bx + 1)
+            dy = ty - (by + 1)
+            if dx * dx + dy * dy < r2:
+                if dx * dx > dy * dy:
+                    tx = bx + 1 - r
+                else:
+                    ty = by + 1 - r
+
+        return (tx, ty)
 
 
 class Player(Actor):
@@ -392,10 +545,10 @@ class Player(Actor):
         self.facing_scaler = 1.0
         self.vplane_scaler = 1.0
 
-    # Draw the player position and orientation overlaid on the on-screen map:
-    def render(self, map: RBZMap, screen):
+    # Screen coordinates of the facing line and viewplane line, for the on-screen map:
+    def view_lines(self, map: RBZMap):
         flipper = -1 if FLIPPED else 1
-        (cx,cy) = super().render(map, screen)
+        (cx,cy) = self.body_rect(map).center
         _, _, fx, fy, vx, vy = self.current_view_vectors()
         fx *= flipper
         vx *= flipper
@@ -404,8 +557,24 @@ class Player(Actor):
         fy *= s
         vx *= s
         vy *= s
-        pygame.draw.line(screen, (255,0,0), (cx,cy), (cx+fx,cy+fy)) # Draw facing line
-        pygame.draw.line(screen, (255,0,0), (cx+fx-vx,cy+fy-vy), (cx+fx+vx,cy+fy+vy)) # Draw viewplane
+        return [
+            ((cx,cy), (cx+fx,cy+fy)),               # Facing line
+            ((cx+fx-vx,cy+fy-vy), (cx+fx+vx,cy+fy+vy)), # Viewplane
+        ]
+
+    def screen_rect(self, map: RBZMap):
+        r = super().screen_rect(map)
+        points = [p for line in self.view_lines(map) for p in line]
+        xs = [p[0] for p in points]
+        ys = [p[1] for p in points]
+        # (Lines can be drawn up to a pixel past their end points.)
+        return r.union(pygame.Rect(min(xs)-1, min(ys)-1, max(xs)-min(xs)+3, max(ys)-min(ys)+3))
+
+    # Draw the player position and orientation overlaid on the on-screen map:
+    def render(self, map: RBZMap, screen):
+        super().render(map, screen)
+        for start, end in self.view_lines(map):
+            pygame.draw.line(screen, (255,0,0), start, end)
 
     # Adjust the current player orientation by applying a rotational transformation:
     def rotate_vectors(self, a):
@@ -442,14 +611,14 @@ class Player(Actor):
         # normalising movement (so it doesn't exceed maximum when multiple keys are pressed):
         mag = math.sqrt(mx*mx + my*my)
         if mag != 0.0:
-            player.move(step*mx/mag, step*my/mag, clip_map)
+            self.move(step*mx/mag, step*my/mag, clip_map)
 
         # Keyboard rotation:
         if dir_keys[KEY_CCW  ]: ma -= delta_time/1000.0 * flipper
         if dir_keys[KEY_CW   ]: ma += delta_time/1000.0 * flipper
         # Mouse rotation:
         ma += mouse*mouse_rotate_speed
-        player.rotate_vectors(ma*flipper)
+        self.rotate_vectors(ma*flipper)
         
     # Convert a given floating-point number to a fixed-point representation,
     # optionally returning the value as an integer or string of binary digits:
@@ -499,87 +668,6 @@ class Player(Actor):
         else:
             return Player.float_to_fixed(m[k], q[k], binary)
 
-    # Apply a motion vector to the player position, optionally using
-    # collision detection (clipping):
-    def move(self, x: float, y: float, clip_map: RBZMap = None):
-        if clip_map is None:
-            self.x += x
-            self.y += y
-        else:
-            (self.x, self.y) = self.try_move(x, y, clip_map)
-
-    # Determine new position by attempting to move on the vector (x,y)
-    # while respecting collision detection. This is basically a reimplementation of:
-    # https://dev.opera.com/articles/3d-games-with-canvas-and-raycasting-part-2/#collision-detection
-    def try_move(self, x: float, y: float, map: RBZMap):
-        r = self.size / 2.0
-        r2 = r*r
-        m = map.cell
-        # From:
-        fx = self.x
-        fy = self.y
-        # To:
-        tx = fx + x
-        ty = fy + y
-        if DISABLE_COLLISIONS:
-            return (tx, ty)
-        # Sanity check:
-        #TODO: Put in clamping/wrapping to map dimensions.
-        # Quantize to map cell coords:
-        bx = int(tx)
-        by = int(ty)
-        if m(bx, by): return (fx, fy) # Player is trying to move completely into a blocking cell; stop the move completely.
-        ct = m(bx+0, by-1) # Up 1 cell.
-        cb = m(bx+0, by+1) # Down 1 cell.
-        cl = m(bx-1, by+0) # Left 1 cell.
-        cr = m(bx+1, by+0) # Right 1 cell.
-        if (ct and ty  -by < r): ty = by   + r
-        if (cb and by+1-ty < r): ty = by+1 - r
-        if (cl and tx  -bx < r): tx = bx   + r
-        if (cr and bx+1-tx < r): tx = bx+1 - r
-
-        # is tile to the top-left a wall
-        if m(bx - 1, by - 1) and not (ct and cl):
-            dx = tx - bx
-            dy = ty - by
-            if dx * dx + dy * dy < r2:
-                if dx * dx > dy * dy:
-                    tx = bx + r
-                else:
-                    ty = by + r
-
-        # is tile to the top-right a wall
-        if m(bx + 1, by - 1) and not (ct and cr):
-            dx = tx - (bx + 1)
-            dy = ty - by
-            if dx * dx + dy * dy < r2:
-                if dx * dx > dy * dy:
-                    tx = bx + 1 - r
-                else:
-                    ty = by + r
-
-        # is tile to the bottom-left a wall
-        if m(bx - 1, by + 1) and not (cb and cl):
-            dx = tx - bx
-            dy = ty - (by + 1)
-            if dx * dx + dy * dy < r2:
-                if dx * dx > dy * dy:
-                    tx = bx + r
-                else:
-                    ty = by + 1 - r
-
-        # is tile to the bottom-right a wall
-        if m(bx + 1, by + 1) and not (cb and cr):
-            dx = tx - (bx + 1)
-            dy = ty - (by + 1)
-            if dx * dx + dy * dy < r2:
-                if dx * dx > dy * dy:
-                    tx = bx + 1 - r
-                else:
-                    ty = by + 1 - r
-
-        return (tx, ty)
-
 
 misses = 0 # [] # Keeps track of updates where we missed our timing target.
 
@@ -587,7 +675,20 @@ misses = 0 # [] # Keeps track of updates where we missed our timing target.
 player = Player(11.5, 10.5)
 
 # Create the environment:
-game_map = RBZMap(raybox)
+game_map = RBZMap(updates)
+
+# Everything else that moves (currently just projectiles):
+entities = Entities()
+KIND_PROJECTILE = 1
+
+# Fire a projectile from the player, in the direction they're facing:
+def fire():
+    _, _, fx, fy, _, _ = player.current_view_vectors()
+    mag = math.hypot(fx, fy)
+    entities.spawn(
+        player.x, player.y, fx/mag*PROJECTILE_SPEED, fy/mag*PROJECTILE_SPEED,
+        PROJECTILE_SIZE, player.a, PROJECTILE_TTL, KIND_PROJECTILE, HIT_DIE
+    )
 
 # Direction keys: QWEASD, hence W=1, A=3, S=4, D=5
 dir_keys    = [False] * 6
@@ -605,95 +706,171 @@ frame_count = 0
 
 fps_text = None
 
+delta           = 0     # Time between the last two I/O ticks.
+mouse_accum     = 0     # Mouse motion since the simulation stage last ran.
+shift_key = alt_key = ctrl_key = 0
+keys = pygame.key.get_pressed()
+
+# Runs each stage of the main loop at its own rate, and says when the next one is due,
+# so that the main loop can sleep until then instead of spinning:
+class Scheduler:
+    def __init__(self):
+        self.stages = [] # Each is [next deadline, period, function].
+
+    # 'first' is the first deadline, if it's not to be one period from now:
+    def add(self, period, fn, first=None):
+        self.stages.append([ts()+period if first is None else first, period, fn])
+
+    def next_due(self):
+        return min(stage[0] for stage in self.stages)
+
+    # Run every stage whose deadline has passed, and schedule its next deadline
+    # (skipping any whole periods that we missed entirely):
+    def run_due(self):
+        for stage in self.stages:
+            now = ts()
+            due, period, fn = stage
+            if now >= due:
+                fn(now)
+                stage[0] = due + ((now-due)//period + 1)*period
+
+# Draws the preview window as a static layer (background, map, etc., only redrawn when its 'key' changes),
+# with 'items' drawn on top. Each item is (name, key, rect, draw), where 'key' changes whenever the item's
+# appearance does, 'rect' is the screen area it covers, and draw(screen) draws it. Only rects where something
+# has changed since the last frame are redrawn (static layer first, then any items in them, in order),
+# and these are returned, to pass to pygame.display.update():
+class Compositor:
+    def __init__(self):
+        self.static = None
+        self.static_key = None
+        self.drawn = {} # name -> (key, rect) of each item last drawn.
+
+    def compose(self, screen, static_key, draw_static, items):
+        if self.static is None or static_key != self.static_key or self.static.get_size() != screen.get_size():
+            self.static = pygame.Surface(screen.get_size())
+            self.static_key = static_key
+            draw_static(self.static)
+            dirty = [screen.get_rect()]
+        else:
+            dirty = []
+            for name, key, rect, _ in items:
+                old = self.drawn.pop(name, None)
+                if old != (key, rect):
+                    if old is not None: dirty.append(old[1])
+                    dirty.append(rect)
+            dirty += [rect for _, rect in self.drawn.values()] # Items that have gone.
+        for d in dirty:
+            screen.set_clip(d)
+            screen.blit(self.static, d, d)
+            for _, _, rect, draw in items:
+                if rect.colliderect(d): draw(screen)
+        screen.set_clip(None)
+        self.drawn = {name: (key, rect) for name, key, rect, _ in items}
+        return dirty
+
+compositor = Compositor()
+
+# Sleep until 'deadline' (ns, per ts()), waking early for input events.
+# Most of the sleep is an event wait (in whole ms), then a finer sleep for what's left,
+# up until SPIN_NS before the deadline, and then we spin for the last bit (which OS sleeps
+# aren't precise enough for). Returns an event if one woke us up, else None:
+def wait_until(deadline):
+    ms = (deadline - ts() - SPIN_NS) // NSMS
+    if ms >= 1:
+        event = pygame.event.wait(int(ms))
+        if event.type != pygame.NOEVENT:
+            return event
+    remaining = deadline - ts() - SPIN_NS
+    if remaining > 0:
+        time.sleep(remaining/1e9)
+    while ts() < deadline:
+        pass
+    return None
+
+# Handle one key/mouse/window event:
+def handle_event(event):
+    global event_counter, running, pause
+    event_counter += 1
+    if event.type == pygame.QUIT:
+        print("Exiting: Pygame QUIT event")
+        running = False
+    elif event.type == pygame.MOUSEBUTTONDOWN:
+        if event.button == 1 and not pause:
+            game_map.env_flash(True)
+            player.zoom_pulse(True)
+            fire()
+    elif event.type == pygame.MOUSEWHEEL:
+        mult = 1.0
+        add_speed = 1
+        zoom_speed = 0.01
+        # Modifier keys scale mousewheel movements:
+        if ctrl_key:    mult *= 2
+        if shift_key:   mult *= 4
+        if alt_key:     mult *= 8
+        adjust_fov = True
+        if keys[pygame.K_0]:
+            adjust_fov = False
+            if FLIPPED:
+                game_map.floor_color += event.y * add_speed * mult
+            else:
+                game_map.sky_color += event.y * add_speed * mult
+        if keys[pygame.K_1]:
+            adjust_fov = False
+            if FLIPPED:
+                game_map.sky_color += event.y * add_speed * mult
+            else:
+                game_map.floor_color += event.y * add_speed * mult
+        if keys[pygame.K_2]:
+            adjust_fov = False
+            game_map.leak += event.y * add_speed * mult
+        if adjust_fov:
+            player.facing_scaler *= 1.0 + event.y * zoom_speed * mult
+    elif event.type == pygame.KEYDOWN:
+        if event.key == pygame.K_ESCAPE:
+                print("Exiting: ESC key pressed")
+                running = False
+        elif event.key == pygame.K_F11:
+            pause = not pause
+            if pause:
+                print("Pausing...")
+            else:
+                print("Resuming from pause...")
+        elif event.key == pygame.K_m or event.key == pygame.K_F12:
+            print("Toggle mouse capture:", "captured" if capture_mouse() else "released")
+        elif event.key == pygame.K_r:
+            print("Reset game state")
+            player.reset()
+            game_map.reset()
+        elif event.key == pygame.K_v:
+            show_view(not view_enabled)
+            print(f"Virtual view {'ON' if view_enabled else 'OFF'}")
+        elif event.key == pygame.K_BACKQUOTE:
+            if USE_TRANSPORT:
+                # Result arrives later, via the transport's worker thread:
+                device.toggle_debug().add_done_callback(
+                    lambda f: f.cancelled() or f.exception() or report_debug(f.result())
+                )
+            else:
+                report_debug(raybox.toggle_debug())
+        elif FLIPPED:
+            if   event.key == pygame.K_KP_9: game_map.floor_color+= 1 # Increment floor colour.
+            elif event.key == pygame.K_KP_7: game_map.floor_color-= 1 # Decrement floor colour.
+            elif event.key == pygame.K_KP_3: game_map.sky_color  += 1 # Increment sky colour.
+            elif event.key == pygame.K_KP_1: game_map.sky_color  -= 1 # Decrement sky colour.
+        else:
+            if   event.key == pygame.K_KP_9: game_map.sky_color  += 1 # Increment sky colour.
+            elif event.key == pygame.K_KP_7: game_map.sky_color  -= 1 # Decrement sky colour.
+            elif event.key == pygame.K_KP_3: game_map.floor_color+= 1 # Increment floor colour.
+            elif event.key == pygame.K_KP_1: game_map.floor_color-= 1 # Decrement floor colour.
 
-while running:
+def report_debug(state):
+    print(f"Turning Vectors DEBUG signal {'ON' if state else 'OFF'}")
 
+# Stage: Poll keyboard/mouse state, and handle any events:
+def input_stage(now):
+    global mouse_accum, shift_key, alt_key, ctrl_key, keys, dir_keys
     mouse_delta = pygame.mouse.get_rel()
-
-    loop_counter += 1
-    now = ts()
-    delta = now-timer   # Time since last tick was registered.
-
-
-    if delta >= TICK:
-        # The way I've designed this currently, it will attempt to send rendering update control data
-        # to Raybox every `TICK` nanoseconds.
-        
-        # OK, hit our scheduled target:
-        # At the least, our target has elapsed... probably a little more.
-        hit_counter += 1                            # Increment hit counter.
-        if delta > max_delta: max_delta = delta     # Used for finding max_delta.
-        sum_deltas += delta                         # Used for calculating average.
-        ticks = int(delta/TICK)
-        if ticks > 1: misses += 1 # misses.append(hit_counter)
-        tick_counter += ticks                       # Count of what would be WHOLE ticks since start.
-        timer += int(delta/TICK)*TICK               # Update timer to refer to what WOULD'VE been the start of this tick.
-
-        # Get vectors as fixed-point hex values:
-        vectors = player.fixed(binary=True)
-
-        raybox.set_raw_pov(''.join(vectors))
-        game_map.env_flash()
-        player.zoom_pulse()
-
-        # Render our preview window:
-        screen.fill((40,80,120))
-        game_map.draw(screen)
-        player.render(game_map, screen)
-        screen.blit(info_text, (0,0))
-        # Draw WASD keys overlay:
-        for n in range(6):
-            if True: #n != 0 and n!= 2:
-                pygame.draw.rect(
-                    screen,
-                    (0,255,0),
-                    pygame.Rect( 20+(n%3)*32, 20+(n//3)*32, 30, 30),
-                    0 if dir_keys[n] else 1, 4
-                )
-        # Display other data:
-        # Vectors (decimal floating-point):
-        px, py, fx, fy, vx, vy = player.current_view_vectors()
-        text = font.render(
-            f"player({px:15.6f}, {py:15.6f})  "+
-            f"facing({fx:11.6f}, {fy:11.6f})  "+
-            f"vplane({vx:11.6f}, {vy:11.6f})", True, (255,255,255))
-        rect = text.get_rect()
-        rect.bottomright = (SCREEN_W, SCREEN_H-rect.height)
-        screen.blit(text, rect)
-        
-        # Vectors (hex fixed-point):
-        text = font.render(
-            f"player({vectors[0]}, {vectors[1]})  "+
-            f"facing({vectors[2]}, {vectors[3]})  "+
-            f"vplane({vectors[4]}, {vectors[5]})", True, (255,255,255))
-        rect = text.get_rect()
-        rect.bottomright = (SCREEN_W, SCREEN_H)
-        screen.blit(text, rect)
-
-        # Calculate FPS:
-        if frame_count >= 10:
-            time_delta = float(pygame.time.get_ticks()-last_fps_time)/1000.0
-            fps = 10.0 / time_delta
-            fps_text = font.render( f"FPS: {fps:6.1f}", True, (255,255,255) )
-            frame_count = 0
-        if fps_text is not None:
-            rect = fps_text.get_rect()
-            rect.topright = (SCREEN_W, 0)
-            screen.blit(fps_text,rect)
-        pygame.display.flip()
-        if frame_count == 0:
-            last_fps_time = pygame.time.get_ticks() # In ms.
-        frame_count += 1
-
-        if DEBUG:
-            print(
-                f"{ts()/NSMS:11.4f}: Hit {hit_counter:4} of {tick_counter:4} ticks at {timer/NSMS:11.4f}ms."
-                f" Delta:{delta/NSMS:7.4f}ms. Loops:{loop_counter:5}",
-            )
-        if min_loops is None or loop_counter < min_loops: min_loops = loop_counter
-        if loop_counter > max_loops: max_loops = loop_counter
-        sum_loops += loop_counter
-        loop_counter = 0  # Reset loop counter.
+    mouse_accum += mouse_delta[0] if not ROTATE_MOUSE else mouse_delta[1]
 
     mods = pygame.key.get_mods()
     shift_key   = mods & pygame.KMOD_SHIFT
@@ -715,78 +892,158 @@ while running:
 
     # Check if we've got any key KB/mouse/window events we have to process:
     for event in pygame.event.get():
-        event_counter += 1
-        if event.type == pygame.QUIT:
-            print("Exiting: Pygame QUIT event")
-            running = False
-        elif event.type == pygame.MOUSEBUTTONDOWN:
-            if event.button == 1 and not pause:
-                game_map.env_flash(True)
-                player.zoom_pulse(True)
-        elif event.type == pygame.MOUSEWHEEL:
-            mult = 1.0
-            add_speed = 1
-            zoom_speed = 0.01
-            # Modifier keys scale mousewheel movements:
-            if ctrl_key:    mult *= 2
-            if shift_key:   mult *= 4
-            if alt_key:     mult *= 8
-            adjust_fov = True
-            if keys[pygame.K_0]:
-                adjust_fov = False
-                if FLIPPED:
-                    game_map.floor_color += event.y * add_speed * mult
-                else:
-                    game_map.sky_color += event.y * add_speed * mult
-            if keys[pygame.K_1]:
-                adjust_fov = False
-                if FLIPPED:
-                    game_map.sky_color += event.y * add_speed * mult
-                else:
-                    game_map.floor_color += event.y * add_speed * mult
-            if keys[pygame.K_2]:
-                adjust_fov = False
-                game_map.leak += event.y * add_speed * mult
-            if adjust_fov:
-                player.facing_scaler *= 1.0 + event.y * zoom_speed * mult
-        elif event.type == pygame.KEYDOWN:
-            if event.key == pygame.K_ESCAPE:
-                    print("Exiting: ESC key pressed")
-                    running = False
-            elif event.key == pygame.K_F11:
-                pause = not pause
-                if pause:
-                    print("Pausing...")
-                else:
-                    print("Resuming from pause...")
-            elif event.key == pygame.K_m or event.key == pygame.K_F12:
-                print("Toggle mouse capture:", "captured" if capture_mouse() else "released")
-            elif event.key == pygame.K_r:
-                print("Reset game state")
-                player.reset()
-                game_map.reset()
-            elif event.key == pygame.K_BACKQUOTE:
-                r = raybox.toggle_debug()
-                print(f"Turning Vectors DEBUG signal {'ON' if r else 'OFF'}")
-            elif FLIPPED:
-                if   event.key == pygame.K_KP_9: game_map.floor_color+= 1 # Increment floor colour.
-                elif event.key == pygame.K_KP_7: game_map.floor_color-= 1 # Decrement floor colour.
-                elif event.key == pygame.K_KP_3: game_map.sky_color  += 1 # Increment sky colour.
-                elif event.key == pygame.K_KP_1: game_map.sky_color  -= 1 # Decrement sky colour.
-            else:
-                if   event.key == pygame.K_KP_9: game_map.sky_color  += 1 # Increment sky colour.
-                elif event.key == pygame.K_KP_7: game_map.sky_color  -= 1 # Decrement sky colour.
-                elif event.key == pygame.K_KP_3: game_map.floor_color+= 1 # Increment floor colour.
-                elif event.key == pygame.K_KP_1: game_map.floor_color-= 1 # Decrement floor colour.
+        handle_event(event)
 
-    # Update game state based on inputs and time elapsed:
+# Stage: Update game state based on inputs and time elapsed:
+def sim_stage(now):
+    global last_time, mouse_accum
     this_time = pygame.time.get_ticks()
     delta_time = this_time - last_time
     last_time = this_time
-    mouse_move = mouse_delta[0] if not ROTATE_MOUSE else mouse_delta[1]
+    mouse_move, mouse_accum = mouse_accum, 0
     if not pause:
         player.recalc_vectors(dir_keys, delta_time, mouse_move, shift_key, alt_key, game_map)
+        entities.step(delta_time/1000.0, None if DISABLE_COLLISIONS else game_map.walls)
 
+# Stage: Send rendering update control data to Raybox, every `TICK` nanoseconds:
+def io_stage(now):
+    global delta, hit_counter, max_delta, sum_deltas, misses, tick_counter, timer
+    global min_loops, max_loops, sum_loops, loop_counter
+    delta = now-timer   # Time since last tick was registered.
+
+    # OK, hit our scheduled target:
+    # At the least, our target has elapsed... probably a little more.
+    hit_counter += 1                            # Increment hit counter.
+    if delta > max_delta: max_delta = delta     # Used for finding max_delta.
+    sum_deltas += delta                         # Used for calculating average.
+    ticks = int(delta/TICK)
+    if ticks > 1: misses += 1 # misses.append(hit_counter)
+    tick_counter += ticks                       # Count of what would be WHOLE ticks since start.
+    timer += int(delta/TICK)*TICK               # Update timer to refer to what WOULD'VE been the start of this tick.
+
+    # Get vectors as fixed-point hex values:
+    vectors = player.fixed(binary=True)
+
+    # Send the POV along with any register changes queued since the last tick:
+    game_map.env_flash()
+    updates.commit(''.join(vectors))
+    player.zoom_pulse()
+
+    if DEBUG:
+        print(
+            f"{ts()/NSMS:11.4f}: Hit {hit_counter:4} of {tick_counter:4} ticks at {timer/NSMS:11.4f}ms."
+            f" Delta:{delta/NSMS:7.4f}ms. Loops:{loop_counter:5}",
+        )
+    if min_loops is None or loop_counter < min_loops: min_loops = loop_counter
+    if loop_counter > max_loops: max_loops = loop_counter
+    sum_loops += loop_counter
+    loop_counter = 0  # Reset loop counter.
+
+# Bring the virtual view up to date, i.e. render what the board has been sent (if it's changed since last time),
+# the way up it would be on the rotated monitor (where each ASIC line is a column, with floor at the bottom):
+view_key = None
+view_scaled = None
+def update_view():
+    global view_time, view_key, view_scaled
+    key = (tuple(view_model.pov), view_model.sky, view_model.floor, view_model.leak)
+    if key != view_key:
+        t = time.perf_counter_ns()
+        frame = view_model.render()
+        pygame.surfarray.blit_array(view_surface, frame[::-1, :] if FLIPPED else frame[:, ::-1])
+        view_scaled = pygame.transform.scale(view_surface, (VIEW_W, VIEW_H))
+        view_time = time.perf_counter_ns() - t
+        view_key = key
+    return view_key
+
+# Static layer of the preview window:
+def draw_static(surface):
+    surface.fill((40,80,120))
+    game_map.draw(surface)
+    surface.blit(info_text, (0,0))
+
+# Stage: Render our preview window:
+def preview_stage(now):
+    global fps_text, frame_count, last_fps_time
+    vectors = player.fixed(binary=True)
+    items = [] # For the compositor: (name, key, rect, draw)
+    def add_text(name, surface, **position):
+        rect = surface.get_rect(**position)
+        items.append((name, surface, rect, lambda screen: screen.blit(surface, rect)))
+    items.append((
+        'player',
+        (player.body_rect(game_map), player.view_lines(game_map)),
+        player.screen_rect(game_map),
+        lambda screen: player.render(game_map, screen),
+    ))
+    # Entities, as dots on the map:
+    living = entities.living()
+    if len(living):
+        sx, sy = game_map.xy_screen_array(entities.x[living], entities.y[living])
+        def draw_entities(screen, sx=sx, sy=sy):
+            for x, y in zip(sx.tolist(), sy.tolist()):
+                pygame.draw.rect(screen, (255,255,0), (x-1, y-1, 3, 3))
+        items.append((
+            'entities', (sx.tobytes(), sy.tobytes()),
+            pygame.Rect(sx.min()-1, sy.min()-1, sx.max()-sx.min()+3, sy.max()-sy.min()+3),
+            draw_entities,
+        ))
+    if view_enabled:
+        # (After the player, so it covers anything on the map that's zoomed into its area.)
+        items.append(('view', update_view(), pygame.Rect(SCREEN_W, 0, VIEW_W, VIEW_H), lambda screen: screen.blit(view_scaled, (SCREEN_W, 0))))
+    # WASD keys overlay:
+    for n in range(6):
+        rect = pygame.Rect( 20+(n%3)*32, 20+(n//3)*32, 30, 30)
+        pressed = bool(dir_keys[n])
+        items.append((
+            f'key{n}', pressed, rect,
+            lambda screen, rect=rect, pressed=pressed: pygame.draw.rect(screen, (0,255,0), rect, 0 if pressed else 1, 4)
+        ))
+    # Display other data:
+    # Vectors (decimal floating-point):
+    px, py, fx, fy, vx, vy = player.current_view_vectors()
+    text = text_surface(
+        f"player({px:15.6f}, {py:15.6f})  "+
+        f"facing({fx:11.6f}, {fy:11.6f})  "+
+        f"vplane({vx:11.6f}, {vy:11.6f})")
+    add_text('vectors', text, bottomright=(SCREEN_W, SCREEN_H-text.get_height()))
+
+    # Vectors (hex fixed-point):
+    text = text_surface(
+        f"player({vectors[0]}, {vectors[1]})  "+
+        f"facing({vectors[2]}, {vectors[3]})  "+
+        f"vplane({vectors[4]}, {vectors[5]})")
+    add_text('fixed', text, bottomright=(SCREEN_W, SCREEN_H))
+
+    # Calculate FPS:
+    if frame_count >= 10:
+        time_delta = float(pygame.time.get_ticks()-last_fps_time)/1000.0
+        fps = 10.0 / time_delta
+        view_text = f"  View: {view_time/NSMS:5.2f}ms" if view_enabled else ""
+        fps_text = font.render( f"FPS: {fps:6.1f}{view_text}", True, (255,255,255) )
+        frame_count = 0
+    if fps_text is not None:
+        add_text('fps', fps_text, topright=(SCREEN_W, 0))
+    dirty = compositor.compose(screen, id(game_map.map_surface), draw_static, items)
+    pygame.display.update(dirty)
+    if frame_count == 0:
+        last_fps_time = pygame.time.get_ticks() # In ms.
+    frame_count += 1
+
+scheduler = Scheduler()
+scheduler.add(INPUT_PERIOD, input_stage)
+scheduler.add(SIM_PERIOD, sim_stage)
+scheduler.add(TICK, io_stage, timer+TICK) # Keep to the same tick grid as 'timer'.
+scheduler.add(PREVIEW_PERIOD, preview_stage)
+input_stage(ts())
+
+while running:
+    loop_counter += 1
+    # Sleep until the next stage is due, but handle input events as soon as they arrive:
+    event = wait_until(scheduler.next_due())
+    if event is not None:
+        handle_event(event)
+        continue
+    scheduler.run_due()
 
 
 # Display stats:
@@ -802,3 +1059,11 @@ print(f"Avg loops: {int(sum_loops/hit_counter):5}")
 print(f"Max delta: {max_delta/NSMS:6.3f}ms")
 print(f"Avg delta: {sum_deltas/hit_counter/NSMS:6.3f}ms")
 print(f"Pygame events: {event_counter}")
+if USE_TRANSPORT:
+    device.close() # Finish sending anything still queued, so we can then use raybox directly.
+    print(f"Transport: {device.metrics()}")
+print(f"POV updates: {raybox.stats['pov_sent']} sent ({raybox.stats['pov_heartbeat']} heartbeats), {raybox.stats['pov_suppressed']} suppressed")
+print(f"Register writes: {raybox.stats['reg_sent']} sent, {raybox.stats['reg_merged']} merged, {raybox.stats['reg_redundant']} redundant")
+if raybox.vblank_sync:
+    vblank = raybox.vblank_stats()
+    print(f"vblank sync: {vblank['updated']} frames updated, {vblank['dropped']} POVs dropped, {vblank['idle']} frames idle")
@@ -0,0 +1,252 @@
+# This is a NumPy software model of what raybox-zero renders for a given POV, map and registers,
+# used to preview/predict the ASIC's output on the host (in milliseconds) without hardware or RTL simulation.
+#
+# Like the ASIC, the display is 'portrait': each of the 480 visible VGA lines is one ray (spread
+# across the viewplane), and along each line (640 pixels) we get floor, then wall, then sky.
+# All 480 rays are traced together with a batched DDA (per Lode's raycasting tutorial).
+#
+# NOTE: Wall geometry, light/dark sides and sky/floor/leak registers follow the design, but wall
+# textures here are simple stand-ins for those generated by row_render.v (in the raybox-zero submodule),
+# and the debug/map overlays are not modelled, so don't expect an exact pixel match with the ASIC.
+#
+# Run it directly to render a POV to an image, e.g.:
+#   python3 raybox_model.py 00011010000000000100110100000000000000000010000000001110000000000000000000 -o pov.ppm
+
+import sys
+import numpy as np
+
+WIDTH       = 640   # Visible pixels per line (i.e. wall height axis).
+HEIGHT      = 480   # Visible lines (i.e. one ray per line).
+WALL_SCALE  = 480.0 # Wall size (in pixels) at a distance of 1.0, for a 1:1 aspect ratio when vplane magnitude is 0.5.
+TEX_SIZE    = 64    # Texels per wall, in each direction.
+SPLIT       = 0xFF  # Marks texels in render()'s tables that should show floor or sky instead (i.e. not an RGB222 value).
+
+# Build the same map as map_rom.v, i.e. a list of cell values (0=empty, 1..3=wall type)
+# stored as Y/X (i.e. index is x*rows+y) per
+# https://github.com/algofoogle/raybox-zero/blob/main/src/rtl/map_rom.v
+def map_rom(cols=16, rows=16):
+    map_data = [0] * (cols * rows)
+    w = cols
+    h = rows
+    for y in range(h):
+        for x in range(w):
+
+            left_right_borders = (x == 0) | (x == (w - 1))
+            top_bottom_borders = (y == 0) | (y == (h - 1))
+
+            low_3_bits_match = ((y & 0b111)^0b111 == (x & 0b111))
+            bit_3_of_y_and_x_are_zero = ((y & 0b1000) == 0) & ((x & 0b1000) == 0)
+
+            expression1 = low_3_bits_match & bit_3_of_y_and_x_are_zero
+
+            bitwise_ops = ((((y & 0b10) ^ ( (x & 0b100) >> 1)))>>1) ^ ((y & 1) & ((x >> 1) & 1))
+            expression2 = bitwise_ops & ((y & 0b100)>>2) & ((x & 0b10)>>1)
+            expression3 = ((y & 1)^1) & ((x & 1)^1)
+
+            expression4 = (expression2 | expression3)
+            bits_2_match = ((y & 0b100)>>2) ^ ~((x & 0b100)>>2)
+
+            c = (
+                (left_right_borders) |
+                (top_bottom_borders) |
+                (expression1) |
+                (expression4 & bits_2_match)
+            )
+
+            b0 = 0b01 if c else 0b00
+
+            f1 = (x>>3) & 1; f2 = (x>>2) & 1; f3 = (x>>1) & 1; f4 = x & 1
+            a6 = (y>>3) & 1; b6 = (y>>2) & 1; c6 = (y>>1) & 1; d6 = y & 1
+            d = 1 if (x==8 and y==10) else 0
+            c = ((((f3^d6) & (f2^a6)) & (f4^b6)) & (f1^c6)) | d
+            b1 = 0b10 if c else 0b00
+
+            map_data[x*rows + y] = b1|b0
+    return map_data
+
+# Convert a fixed-point integer (as used in the POV) back to a float:
+def fixed_to_float(t: int, q: str) -> float:
+    if q == 'UQ6.9':
+        return (t & 0x7FFF) / 2.0**9.0
+    elif q == 'SQ2.9':
+        t &= 0x7FF
+        if t & 0x400: t -= 0x800 # Sign-extend.
+        return t / 2.0**9.0
+    else:
+        raise Exception(f"Unsupported fixed-point format: {q}")
+
+POV_FORMATS = [('UQ6.9', 15), ('UQ6.9', 15), ('SQ2.9', 11), ('SQ2.9', 11), ('SQ2.9', 11), ('SQ2.9', 11)]
+
+# Unpack a POV, given either as the 74-bit binary string sent to the ASIC, or as the list of
+# 6 fixed-point values (or their binary strings) from Player.fixed(), into 6 floats:
+# player X/Y, facing X/Y, vplane X/Y.
+def unpack_pov(pov):
+    if type(pov) is str:
+        chunks = []
+        p = 0
+        for q, bits in POV_FORMATS:
+            chunks.append(pov[p:p+bits])
+            p += bits
+        pov = chunks
+    return [
+        fixed_to_float(int(v, 2) if type(v) is str else int(v), q)
+        for v, (q, _) in zip(pov, POV_FORMATS)
+    ]
+
+# Dim an RGB222 (BbGgRr) colour by halving each channel, for the 'dark' side of walls:
+def dim(c):
+    return ((c >> 1) & 0b01_01_01)
+
+# Build stand-in wall textures, indexed by [wall type, side (0=light, 1=dark), texu, texv],
+# with each value being an RGB222 colour:
+def make_textures():
+    u = np.arange(TEX_SIZE)[:,None]
+    v = np.arange(TEX_SIZE)[None,:]
+    tex = np.zeros((4, 2, TEX_SIZE, TEX_SIZE), dtype=np.uint8)
+    #                                           Bb Gg Rr
+    # Type 1: Bricks (pale, with dark mortar):
+    mortar = ((v % 16) == 0) | (((u + (v // 16) % 2 * 16) % 32) == 0)
+    tex[1,0] = np.where(mortar, 0b_01_01_01, 0b_01_10_11)
+    # Type 2: Blue XOR pattern:
+    tex[2,0] = np.where(((u ^ v) & 0b100000) != 0, 0b_11_01_00, 0b_10_00_00)
+    # Type 3: Purple stripes:
+    tex[3,0] = np.where((u // 8) % 2 == 0, 0b_11_00_10, 0b_10_00_01)
+    tex[:,1] = dim(tex[:,0])
+    return tex
+
+# Expand RGB222 (BbGgRr) values to RGB888, e.g. for writing images:
+def rgb222_to_rgb888(frame):
+    levels = np.array([0, 85, 170, 255], dtype=np.uint8)
+    return np.stack([
+        levels[frame & 0b11],
+        levels[(frame >> 2) & 0b11],
+        levels[(frame >> 4) & 0b11],
+    ], axis=-1)
+
+# Represents the state of raybox-zero (POV, map and registers), and can render frames from it:
+class RayboxZeroModel:
+    def __init__(self, map_data=None, cols=16, rows=16):
+        self.cols = cols
+        self.rows = rows
+        if map_data is None: map_data = map_rom(cols, rows)
+        # Map is indexed as [x, y], matching its Y/X storage order:
+        self.map = np.array(map_data, dtype=np.uint8).reshape(cols, rows)
+        self.textures = make_textures()
+        self.sky = 0b_01_01_01
+        self.floor = 0b_10_10_10
+        self.leak = 0
+        self.pov = [5.5, 9.625, 0.0, 1.0, -0.5, 0.0]
+        self.x = np.arange(WIDTH, dtype=np.float32)[None,:] # Pixel position along each line.
+        # Buffers for render():
+        self.table = np.zeros((HEIGHT, TEX_SIZE+2), dtype=np.uint8)
+        self.texv = np.zeros((HEIGHT, WIDTH), dtype=np.float32)
+        self.index = np.zeros((HEIGHT, WIDTH), dtype=np.intp)
+        # Offset of each line's table (plus 1, so texel -1 is the floor entry) within self.table:
+        self.row_offset = (np.arange(HEIGHT) * (TEX_SIZE+2) + 1)[:,None]
+
+    def set_raw_pov(self, pov):
+        self.pov = unpack_pov(pov)
+
+    def set_pov(self, px, py, fx, fy, vx, vy):
+        self.pov = [px, py, fx, fy, vx, vy]
+
+    # Same interface for updates as RayboxZeroController, so the model can be sent whatever the board is:
+    def queue_reg(self, name, value):
+        setattr(self, name, int(value) % 64)
+
+    def commit(self, pov=None):
+        if pov is not None: self.set_raw_pov(pov)
+
+    # Trace all rays at once, returning arrays (one element per line) of:
+    # wall type, side (0=X side/light, 1=Y side/dark), perpendicular distance, and texu.
+    def trace(self, lines=HEIGHT):
+        px, py, fx, fy, vx, vy = self.pov
+        px %= self.cols
+        py %= self.rows
+        c = 2.0*np.arange(lines)/lines - 1.0 # Position of each ray across the viewplane, -1..+1.
+        rx = fx + vx*c
+        ry = fy + vy*c
+        # Distance along the ray between X (or Y) grid lines, with 'never' being a big number:
+        with np.errstate(divide='ignore'):
+            ddx = np.where(rx == 0, 1e30, np.abs(1.0/rx))
+            ddy = np.where(ry == 0, 1e30, np.abs(1.0/ry))
+        mx = np.full(lines, int(px))
+        my = np.full(lines, int(py))
+        stepx = np.where(rx < 0, -1, 1)
+        stepy = np.where(ry < 0, -1, 1)
+        sdx = np.where(rx < 0, (px - mx)*ddx, (mx + 1.0 - px)*ddx)
+        sdy = np.where(ry < 0, (py - my)*ddy, (my + 1.0 - py)*ddy)
+        wall = np.zeros(lines, dtype=np.uint8)
+        side = np.zeros(lines, dtype=np.uint8)
+        active = np.ones(lines, dtype=bool)
+        # Worst case is crossing the whole map in both directions:
+        for _ in range(2*(self.cols + self.rows)):
+            xstep = sdx < sdy
+            ystep = ~xstep
+            sdx = np.where(active & xstep, sdx + ddx, sdx)
+            mx  = np.where(active & xstep, mx + stepx, mx)
+            sdy = np.where(active & ystep, sdy + ddy, sdy)
+            my  = np.where(active & ystep, my + stepy, my)
+            side = np.where(active, ystep, side)
+            cell = self.map[mx % self.cols, my % self.rows]
+            hit = active & (cell != 0)
+            wall = np.where(hit, cell, wall)
+            active &= ~hit
+            if not active.any(): break
+        dist = np.where(side == 0, sdx - ddx, sdy - ddy)
+        dist = np.maximum(dist, 1.0/WALL_SCALE)
+        # Where along the wall each ray hit it:
+        hit_pos = np.where(side == 0, py + dist*ry, px + dist*rx)
+        texu = ((hit_pos - np.floor(hit_pos)) * TEX_SIZE).astype(np.int32)
+        return wall, side, dist, np.clip(texu, 0, TEX_SIZE-1)
+
+    # Render the visible area as an array of shape (HEIGHT, WIDTH) of RGB222 colours.
+    # Each line is just floor, then one (scaled) column of wall texture, then sky, so rather than looking
+    # up every pixel in the whole texture set, each line gets a table of [floor, texels 0..63, sky]
+    # and each pixel is one lookup in its line's table. The per-pixel maths is in float32, in buffers
+    # that are reused from frame to frame, which makes this fast enough for a 60fps preview:
+    def render(self):
+        wall, side, dist, texu = self.trace()
+        table = self.table
+        table[:,0] = self.floor
+        table[:,1:-1] = self.textures[wall, side, texu]
+        table[:,-1] = self.sky
+        # Floor 'leak' raises the floor up the wall by the given number of texels, and lines with no wall
+        # are all floor/sky. Either way, these pixels are just floor or sky depending on which half they're in:
+        table[:,1:1+self.leak] = SPLIT
+        table[wall == 0,1:-1] = SPLIT
+        size = WALL_SCALE / dist
+        start = (WIDTH/2.0 - size/2.0)[:,None] # Floor side of the wall.
+        scale = (TEX_SIZE / size)[:,None]       # Texels per pixel.
+        texv = self.texv
+        np.subtract(self.x, start, out=texv)
+        np.multiply(texv, scale, out=texv)
+        np.clip(texv, -1, TEX_SIZE, out=texv)
+        index = self.index
+        index[...] = texv # Truncates.
+        index += self.row_offset
+        frame = np.take(table, index)
+        if self.leak > 0 or not wall.all():
+            frame = np.where(frame == SPLIT, np.where(self.x < WIDTH/2.0, self.floor, self.sky), frame).astype(np.uint8)
+        return frame
+
+    def render_rgb888(self):
+        return rgb222_to_rgb888(self.render())
+
+
+if __name__ == '__main__':
+    import argparse
+    parser = argparse.ArgumentParser(description='Render a raybox-zero POV using the software model')
+    parser.add_argument('pov', nargs='?', help='74-bit POV as a binary string (default: the POV from the README)')
+    parser.add_argument('--sky', type=lambda v: int(v, 0), default=0b_01_01_01, help='Sky colour (RGB222, BbGgRr)')
+    parser.add_argument('--floor', type=lambda v: int(v, 0), default=0b_10_10_10, help='Floor colour (RGB222, BbGgRr)')
+    parser.add_argument('--leak', type=int, default=0, help="Floor 'leak' in texels (0..63)")
+    parser.add_argument('-o', '--output', default='raybox_model.ppm', help='PPM (P6) file to write')
+    args = parser.parse_args()
+    model = RayboxZeroModel()
+    if args.pov is not None: model.set_raw_pov(args.pov)
+    model.sky, model.floor, model.leak = args.sky, args.floor, args.leak
+    rgb = model.render_rgb888()
+    with open(args.output, 'wb') as f:
+        f.write(f"P6\n{WIDTH} {HEIGHT}\n255\n".encode('ascii') + rgb.tobytes())
+    print(f"Wrote {args.output} for POV {model.pov}", file=sys.stderr)
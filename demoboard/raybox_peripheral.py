@@ -3,6 +3,13 @@
 # See raybox-controller.py for the host PC side that sends us commands.
 from machine import Pin, SoftSPI
 
+# 'tt' is a global in the REPL (set up by the TT04 board's main.py), which we can use as-is when our source
+# is sent to the REPL, but if we've instead been imported as a module (e.g. raybox_peripheral.mpy), get it from there:
+try:
+    tt
+except NameError:
+    from __main__ import tt
+
 # Raybox-Zero SPI interface, can talk to either of RBZ's SPI peripherals:
 # - "vectors" (POV) and "registers" (REG)
 class RBZSPI:
@@ -29,24 +36,49 @@ class RBZSPI:
             )
         else:
             raise ValueError(f"Invalid interface {repr(interface)}; must be 'pov' or 'reg'")
+        self.buf = bytearray(16) # Preallocated for packing payloads (biggest is 74 bits).
         
     def enable(self):   self.csb(False)
     def disable(self):  self.csb(True)
 
-    # Expects a binary string or integer as input.
-    # Returns a binary string representation that is the required length (count).
-    def to_bin(self, data, count=None):
-        if type(data) is int:
-            data = bin(data)
-            data = data[2:]
-            if count is None:
-                print(f"WARNING: SPI.send_bits() called with int data {data} but no count")
-        if count is not None:
-            data = ('0'*count + data)[-count:] # Zero-pad (or trim) to the required count.
-        return data
+    # Pack 'data' (as per send()) MSB-first into our preallocated bytearray, zero-padded on the right
+    # to a whole number of bytes, without building any strings. Returns a memoryview of the packed bytes.
+    # (Most raybox-zero SPI payloads are not a multiple of 8 bits, but SoftSPI needs to send whole bytes.
+    # Thankfully raybox-zero SPI interfaces discard extra bits, so padding on the right is fine.)
+    def pack(self, data, count=None):
+        if type(data) is not list: data = [(data, count)]
+        buf = self.buf
+        pos = 0 # Bit position in buf.
+        for chunk in data:
+            if type(chunk) is tuple:
+                value, bits = chunk
+            else:
+                value, bits = chunk, None
+            if type(value) is str:
+                # String of binary digits, zero-padded (or trimmed) on the left to the required count:
+                if bits is None: bits = len(value)
+                j = len(value) - bits
+                for _ in range(bits):
+                    if pos & 7 == 0: buf[pos >> 3] = 0
+                    if j >= 0 and value[j] == '1': buf[pos >> 3] |= 0x80 >> (pos & 7)
+                    j += 1
+                    pos += 1
+            else:
+                if bits is None:
+                    raise ValueError(f"Integer data {value} needs a bit count")
+                # Shift in the lowest 'bits' bits of the integer, as many at a time as fit in the current byte:
+                while bits > 0:
+                    if pos & 7 == 0: buf[pos >> 3] = 0
+                    free = 8 - (pos & 7)
+                    take = free if free < bits else bits
+                    bits -= take
+                    buf[pos >> 3] |= ((value >> bits) & ((1 << take) - 1)) << (free - take)
+                    pos += take
+        return memoryview(buf)[:(pos + 7) >> 3]
 
     # Do an SPI transaction.
     # 'data' is one of:
+    # - bytes or a bytearray, sent as-is.
     # - a string of binary digits, or an array thereof.
     # - an integer (in which case 'count' must be specified also; i.e. required bit count).
     # - an array of tuples; [0] is binary digit string or integer, [1] is required bit count.
@@ -56,29 +88,7 @@ class RBZSPI:
         if type(data) is bytearray or type(data) is bytes:
             self.spi.write(data)
         else:
-            # Build up a binary string:
-            if type(data) is not list:
-                # Just send an explicit value (of a given optional 'count' size):
-                bin = self.to_bin(data, count)
-            else:
-                # Caller wants to concatenate multiple chunks in the one transaction
-                # (e.g. packed data):
-                bin = ''
-                for chunk in data:
-                    if type(chunk) is tuple:
-                        # Tuple means we have both data,
-                        # and the count of bits to transmit for that data:
-                        bin += self.to_bin(chunk[0], chunk[1])
-                    else:
-                        # Not a tuple, so hopefully it's a finite string of bits:
-                        bin += self.to_bin(chunk)
-            # Most raybox-zero SPI payloads are not a multiple of 8 bits,
-            # but this SoftSPI needs to send whole bytes.
-            # Thankfully raybox-zero SPI interfaces discard extra bits,
-            # so we now RIGHT-pad the binary string to a multiple of 8:
-            bin += '0' * (-len(bin) % 8)
-            # Convert this binary string to a bytearray and send it:
-            self.spi.write( int(bin,2).to_bytes(len(bin)//8, 'bin') )
+            self.spi.write(self.pack(data, count))
         self.disable()
 
 class POV(RBZSPI):
@@ -98,5 +108,102 @@ class REG(RBZSPI):
     def floor   (self, color):  self.send([ (self.CMD_FLOOR,4), (color, 6) ]) # Set floor colour (6b data)
     def leak    (self, texels): self.send([ (self.CMD_LEAK, 4), (texels,6) ]) # Set floor 'leak' (in texels; 6b data)
 
+# Holds the newest POV from the host, and only sends it to raybox-zero at the start of vblank
+# (when o_vblank, on uio1, rises), so there's at most one POV update per displayed frame.
+# Counts frames that got a new POV (updated), POVs that were replaced by a newer one before
+# they could be sent (dropped), and frames where there was nothing new to send (idle):
+class VblankScheduler:
+    def __init__(self, tt, pov):
+        self.pov = pov
+        self.pin = tt.uio1
+        self.pin.mode = Pin.IN
+        self.buf = bytearray(10)
+        self.pending = False
+        self.enabled = False
+        self.updated = 0
+        self.dropped = 0
+        self.idle = 0
+
+    def enable(self, state=True):
+        self.pin.raw_pin.irq(handler=self.vblank if state else None, trigger=Pin.IRQ_RISING)
+        self.enabled = state
+
+    # Latch a new POV (10 bytes, as per serve()) to be sent at the next vblank.
+    # No locking is needed (and machine.disable_irq() wouldn't help anyway): vblank() is a scheduled handler,
+    # so it only runs on this same thread, in between bytecodes, and copying into buf is a single bytecode.
+    # At worst, vblank() runs between the lines below, and then a POV is sent twice, or the counts are off by one:
+    def submit(self, data):
+        if self.pending: self.dropped += 1
+        self.buf[:] = data
+        self.pending = True
+
+    # Pin IRQ handler (scheduled, i.e. not a hard IRQ, so it can use SoftSPI):
+    def vblank(self, pin):
+        if self.pending:
+            self.pending = False
+            self.pov.send(self.buf)
+            self.updated += 1
+        else:
+            self.idle += 1
+
+    def stats(self):
+        return f'{self.updated} {self.dropped} {self.idle}'
+
 pov = POV()
 reg = REG()
+vblank = VblankScheduler(tt, pov)
+
+# Binary command stream, which is much lighter than the host sending Python source for every update.
+# The host starts this by calling serve() via the raw REPL, and then sends packets to our stdin:
+#   b'P' + 10 bytes: POV; 74 bits, MSB first, zero-padded to 80 bits.
+#   b'R' + 2 bytes:  REG write; 4-bit command then 6-bit value, MSB first, zero-padded to 16 bits.
+#   b'B' + 1 byte:   Turn vblank sync (see VblankScheduler) on (1) or off (0). While on, POVs are sent at vblank.
+#   b'V':            Get vblank stats; replies b'V' + 'updated dropped idle' + b'\n' (instead of b'K').
+#   b'X':            Exit serve(), back to the raw REPL.
+# Payloads are already in the form the SPI interfaces need, so they're just passed along, but a packet whose padding
+# bits aren't all zero (or a B flag other than 0 or 1) is rejected. That way, the b'~' bytes that the host sends to
+# flush out a partly-received packet (see RESYNC in raybox_controller.py) can never reach the ASIC.
+# We send b'S' once we're ready, then b'K' to acknowledge each packet in turn, or b'?' if we don't
+# know it, or b'E' + message + b'\n' if it failed. The host can have several packets in flight.
+def serve():
+    import sys, micropython
+    rx = sys.stdin.buffer
+    tx = sys.stdout.buffer
+    pov_buf = bytearray(10)
+    reg_buf = bytearray(2)
+    flag = bytearray(1)
+    # Packets are binary and could contain CTRL+C (0x03), which must not raise KeyboardInterrupt:
+    micropython.kbd_intr(-1)
+    try:
+        tx.write(b'S')
+        while True:
+            op = rx.read(1)
+            if op == b'X': break
+            try:
+                if op == b'P':
+                    rx.readinto(pov_buf)
+                    if pov_buf[9] & 0x3F: raise ValueError('POV padding is not zero')
+                    if vblank.enabled:
+                        vblank.submit(pov_buf)
+                    else:
+                        pov.send(pov_buf)
+                elif op == b'R':
+                    rx.readinto(reg_buf)
+                    if reg_buf[1] & 0x3F: raise ValueError('REG padding is not zero')
+                    reg.send(reg_buf)
+                elif op == b'B':
+                    rx.readinto(flag)
+                    if flag[0] > 1: raise ValueError('vblank sync flag must be 0 or 1')
+                    vblank.enable(flag[0] != 0)
+                elif op == b'V':
+                    tx.write(b'V' + vblank.stats().encode() + b'\n')
+                    continue
+                else:
+                    tx.write(b'?')
+                    continue
+            except Exception as e:
+                tx.write(b'E' + repr(e).encode() + b'\n')
+                continue
+            tx.write(b'K')
+    finally:
+        micropython.kbd_intr(3)
@@ -0,0 +1,119 @@
+# Drives a whole set of TT04 boards at once, each with its own RayboxZeroController (see raybox_controller.py).
+# Every board whose USB VID/PID matches (by default, that of MicroPython on the RP2040) is found, they are all
+# initialised in parallel, and then POV (and register) updates can be either:
+# - broadcast: every board gets every update, e.g. to show the same view on a wall of displays; or
+# - sharded: a stream of updates is split between the boards, so aggregate throughput scales with their number.
+# Each board has its own worker thread, so calls on any one board stay in order, while boards run side by side.
+#
+# Run it directly to measure aggregate throughput, e.g.:
+#   python3 raybox_pool.py --mode shard --updates 2000
+
+import argparse
+import math
+import time
+from concurrent.futures import ThreadPoolExecutor
+import serial.tools.list_ports
+from raybox_controller import RayboxZeroController, pov_bits
+
+RP2040_VID = 0x2E8A # Raspberry Pi
+RP2040_PID = 0x0005 # MicroPython
+
+# List the ports of all connected boards with the given USB VID/PID:
+def find_ports(vid=RP2040_VID, pid=RP2040_PID):
+    return sorted(p.device for p in serial.tools.list_ports.comports() if p.vid == vid and p.pid == pid)
+
+class RayboxPool:
+    # 'ports' defaults to all matching boards found by find_ports().
+    def __init__(self, ports=None):
+        if ports is None: ports = find_ports()
+        if len(ports) == 0:
+            raise Exception(f'No boards found with VID:PID {RP2040_VID:04X}:{RP2040_PID:04X}')
+        self.ports = list(ports)
+        self.workers = [ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'raybox-{n}') for n in range(len(ports))]
+        # Each board's init is several round trips plus uploading raybox_peripheral.py, so do them all at once:
+        start = time.perf_counter()
+        futures = [worker.submit(RayboxZeroController, port) for worker, port in zip(self.workers, self.ports)]
+        # Let every init finish (one way or the other) before checking any of them:
+        errors = [f.exception() for f in futures]
+        if any(errors):
+            # Don't leave the boards that did init serving, or their ports and our workers open:
+            for f, worker, error in zip(futures, self.workers, errors):
+                if error is None:
+                    board = f.result()
+                    try:
+                        worker.submit(board.stop_stream).result()
+                    except Exception as e:
+                        print(f'WARNING: Could not stop {board.port} after another board failed: {e}')
+                    board.conn.close()
+                worker.shutdown()
+            failed = [port for port, error in zip(self.ports, errors) if error is not None]
+            print(f'ERROR: Could not initialise board(s): {failed}')
+            raise next(e for e in errors if e is not None)
+        self.boards = [f.result() for f in futures]
+        print(f'Initialised {len(self.boards)} board(s) in {time.perf_counter()-start:.2f} seconds: {self.ports}')
+
+    def __len__(self):
+        return len(self.boards)
+
+    # Call raybox.<method>(*args) on every board in parallel, and wait for them all, returning their results:
+    def broadcast(self, method, *args):
+        futures = [worker.submit(getattr(board, method), *args) for worker, board in zip(self.workers, self.boards)]
+        return [f.result() for f in futures]
+
+    def set_raw_pov(self, pov):     return self.broadcast('set_raw_pov', pov)
+    def commit(self, pov=None):     return self.broadcast('commit', pov)
+    def queue_reg(self, name, value): return self.broadcast('queue_reg', name, value)
+    def set_sky(self, color):       return self.broadcast('set_sky', color)
+    def set_floor(self, color):     return self.broadcast('set_floor', color)
+    def set_leak(self, leak):       return self.broadcast('set_leak', leak)
+    def flush(self):                return self.broadcast('flush')
+
+    # Split a list of POVs between the boards, round-robin (so board n gets POVs n, n+len(self), ...),
+    # and have each send its share, all at the same time. Returns the number sent by each board:
+    def shard(self, povs):
+        def send(board, share):
+            for pov in share: board.set_raw_pov(pov)
+            board.flush()
+            return len(share)
+        n = len(self.boards)
+        futures = [
+            worker.submit(send, board, povs[i::n])
+            for i, (worker, board) in enumerate(zip(self.workers, self.boards))
+        ]
+        return [f.result() for f in futures]
+
+    # Stop every board's stream and close its port, even if another board fails to stop, then stop the workers:
+    def close(self):
+        futures = [worker.submit(board.stop_stream) for worker, board in zip(self.workers, self.boards)]
+        errors = []
+        for f, board in zip(futures, self.boards):
+            try:
+                f.result()
+            except Exception as e:
+                print(f'WARNING: Could not stop {board.port}: {e}')
+                errors.append(e)
+            finally:
+                board.conn.close()
+        for worker in self.workers: worker.shutdown()
+        if errors: raise errors[0]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Drive all connected TT04 boards at once, and measure aggregate POV throughput')
+    parser.add_argument('--port', action='append', help='Serial port or pyserial URL; repeat for more boards (default: all matching boards)')
+    parser.add_argument('--mode', choices=['broadcast', 'shard'], default='shard', help='Send every POV to every board, or split them between boards')
+    parser.add_argument('--updates', type=int, default=1000, help='No. of POVs in the stream')
+    args = parser.parse_args()
+    pool = RayboxPool(args.port)
+    povs = [pov_bits(6.82, 9.5, 2.0*math.pi*i/args.updates) for i in range(args.updates)]
+    start = time.perf_counter()
+    if args.mode == 'shard':
+        pool.shard(povs)
+        sent = len(povs)
+    else:
+        for pov in povs: pool.set_raw_pov(pov)
+        pool.flush()
+        sent = len(povs)*len(pool)
+    elapsed = time.perf_counter() - start
+    print(f'{args.mode}: {sent} updates to {len(pool)} board(s) in {elapsed:.3f} seconds; {sent/elapsed:.1f} updates/sec in total')
+    pool.close()
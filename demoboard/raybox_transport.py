@@ -0,0 +1,154 @@
+# Background I/O for RayboxZeroController, so that a slow (or stalled) device never blocks the caller
+# (e.g. the pygame loop in raybox_game.py). A worker thread owns the controller (and hence its serial
+# connection), and the caller just hands it updates without waiting:
+# - POVs and register writes are 'latest wins': a POV (or register value) that hasn't been sent yet
+#   is simply replaced by a newer one, so the queue can never grow.
+# - Anything else (e.g. toggle_debug) goes in a bounded queue of calls, each returning a Future.
+# Queue depth and latency (from being handed over, to the device having accepted it) are kept in metrics().
+# When streaming, a POV or register write has only been accepted once serve() acks its packet, which (with
+# pipelining) can be after commit() returns, so its latency is recorded by acked() instead.
+
+import collections
+import threading
+import time
+from concurrent.futures import Future
+from raybox_controller import REG_CMDS, pov_packet, reg_packet
+
+MAX_CALLS = 16 # Max. other calls waiting to run. When full, the oldest is dropped (and its Future cancelled).
+
+class RayboxTransport:
+    def __init__(self, raybox):
+        self.raybox = raybox
+        self.cond = threading.Condition()
+        self.pov = None     # Newest POV not yet sent, and when it was handed over (perf_counter_ns).
+        self.regs = {}      # Newest register values not yet sent: name -> (value, when handed over).
+        self.calls = collections.deque() # (future, function, args, when handed over)
+        self.stopping = False
+        self.error = None   # Most recent exception from the device, if any.
+        self.counts = collections.Counter()
+        self.latency = {}   # Per kind ('pov', 'reg', 'call'): [count, total ns, max ns]
+        self.awaiting = {}  # Stream packets committed, but not acked yet: packet -> (kind, when handed over).
+        raybox.on_ack = self.acked
+        self.max_depth = 0
+        self.thread = threading.Thread(target=self.run, name='raybox-transport', daemon=True)
+        self.thread.start()
+
+    # No. of updates/calls waiting for the worker:
+    def depth(self):
+        return (self.pov is not None) + len(self.regs) + len(self.calls)
+
+    def queue_reg(self, name, value):
+        with self.cond:
+            if name in self.regs: self.counts['reg_superseded'] += 1
+            self.regs[name] = (value, time.perf_counter_ns())
+            self.notify()
+
+    # Hand over a POV (along with any queued register writes) to be sent as soon as the worker can:
+    def commit(self, pov=None):
+        with self.cond:
+            if pov is not None:
+                if self.pov is not None: self.counts['pov_superseded'] += 1
+                self.pov = (pov, time.perf_counter_ns())
+            self.notify()
+
+    # Run raybox.<method>(*args) on the worker thread, returning a Future for its result:
+    def call(self, method, *args):
+        future = Future()
+        with self.cond:
+            if len(self.calls) >= MAX_CALLS:
+                self.calls.popleft()[0].cancel()
+                self.counts['call_dropped'] += 1
+            self.calls.append((future, method, args, time.perf_counter_ns()))
+            self.notify()
+        return future
+
+    def toggle_debug(self):
+        return self.call('toggle_debug')
+
+    # (Call with self.cond held.)
+    def notify(self):
+        self.max_depth = max(self.max_depth, self.depth())
+        self.cond.notify()
+
+    def record_latency(self, kind, since):
+        ns = time.perf_counter_ns() - since
+        l = self.latency.setdefault(kind, [0, 0, 0])
+        l[0] += 1
+        l[1] += ns
+        l[2] = max(l[2], ns)
+
+    # Called by the controller (on our worker thread) as serve() acks each stream packet:
+    def acked(self, packet, sent):
+        awaited = self.awaiting.pop(packet, None)
+        if awaited is not None: self.record_latency(*awaited)
+
+    def run(self):
+        while True:
+            with self.cond:
+                idle = self.depth() == 0
+            if idle:
+                # Before waiting for more, get the acks for everything still in flight, so their latency isn't
+                # held up by our wait. Anything still awaited after that was never sent (e.g. a POV suppressed
+                # by commit() for being the same as the last one):
+                try:
+                    self.raybox.flush()
+                except Exception as e:
+                    self.fail(e)
+                self.awaiting.clear()
+            with self.cond:
+                while not self.stopping and self.depth() == 0:
+                    self.cond.wait()
+                if self.depth() == 0: break # Only when stopping, and everything has been sent.
+                pov, self.pov = self.pov, None
+                regs, self.regs = self.regs, {}
+                calls, self.calls = self.calls, collections.deque()
+            try:
+                for name, (value, _) in regs.items():
+                    self.raybox.queue_reg(name, value)
+                if self.raybox.streaming:
+                    for name, (value, since) in regs.items():
+                        self.awaiting[reg_packet(REG_CMDS[name], value)] = ('reg', since)
+                    if pov is not None: self.awaiting[pov_packet(pov[0])] = ('pov', pov[1])
+                    self.raybox.commit(None if pov is None else pov[0])
+                else:
+                    # Not streaming, so commit() only returns once the device has run it:
+                    self.raybox.commit(None if pov is None else pov[0])
+                    for _, since in regs.values(): self.record_latency('reg', since)
+                    if pov is not None: self.record_latency('pov', pov[1])
+            except Exception as e:
+                self.fail(e)
+            for future, method, args, since in calls:
+                if not future.set_running_or_notify_cancel(): continue
+                try:
+                    future.set_result(getattr(self.raybox, method)(*args))
+                    self.record_latency('call', since)
+                except Exception as e:
+                    future.set_exception(e)
+                    self.fail(e)
+
+    def fail(self, e):
+        self.error = e
+        self.counts['errors'] += 1
+        print(f'WARNING: raybox transport error: {e}')
+
+    # Send anything still queued, then stop the worker. Afterwards, raybox can be used directly again:
+    def close(self, timeout=10.0):
+        with self.cond:
+            self.stopping = True
+            self.cond.notify()
+        self.thread.join(timeout)
+        if self.thread.is_alive():
+            print(f'WARNING: raybox transport did not finish within {timeout} seconds')
+        else:
+            self.raybox.on_ack = None
+
+    def metrics(self):
+        with self.cond:
+            m = {
+                'depth': self.depth(),
+                'max_depth': self.max_depth,
+                **self.counts,
+            }
+            for kind, (count, total, worst) in self.latency.items():
+                m[f'{kind}_latency_ms'] = { 'count': count, 'mean': total/count/1e6, 'max': worst/1e6 }
+            return m
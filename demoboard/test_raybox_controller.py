@@ -0,0 +1,155 @@
+# Tests for the host side (raybox_controller.py and raybox_async.py) against an emulated TT04 board
+# (raybox_emulator.py), so they need no hardware. Run them from this directory with:
+#   python3 -m pytest -q
+
+import asyncio
+import time
+import pytest
+import raybox_controller
+from raybox_controller import RayboxZeroController, RayboxCommandError, pov_bits, pov_packet
+from raybox_async import AsyncRayboxZeroController
+from raybox_emulator import EmulatedSerial
+
+# Wait (up to 'timeout' seconds) for condition() to be true, e.g. for a POV held until the next emulated vblank:
+def wait_for(condition, timeout=1.0):
+    deadline = time.monotonic() + timeout
+    while not condition():
+        if time.monotonic() > deadline: return False
+        time.sleep(0.005)
+    return True
+
+@pytest.fixture
+def conn():
+    return EmulatedSerial(latency=0.0002, jitter=0.0001, seed=1)
+
+@pytest.fixture
+def raybox(conn):
+    raybox = RayboxZeroController(conn=conn)
+    yield raybox
+    raybox.stop_stream()
+
+def test_init(raybox, conn):
+    tt = conn.device.tt
+    assert tt.project == raybox_controller.PROJECT
+    assert tt.clock_hz == raybox_controller.CLOCK_SPEED
+    assert conn.device.freq == raybox_controller.MACHINE_FREQ
+    assert raybox.streaming == raybox_controller.USE_STREAM
+    assert raybox.vblank_sync == (raybox_controller.USE_STREAM and raybox_controller.VBLANK_SYNC)
+    assert raybox.device_state()[:4] == (tt.project, tt.clock_hz, conn.device.freq, True)
+
+def test_pov_and_regs(raybox, conn):
+    raybox.set_vblank_sync(False)
+    pov = pov_bits(6.82, 9.5, 1.0)
+    raybox.set_raw_pov(pov)
+    raybox.set_sky(0b01_01_01)
+    raybox.set_floor(0b10_10_10)
+    raybox.set_leak(7)
+    raybox.flush()
+    assert conn.device.asic.pov == int(pov, 2)
+    assert conn.device.asic.regs == { 'sky': 0b01_01_01, 'floor': 0b10_10_10, 'leak': 7 }
+
+def test_commit(raybox, conn):
+    raybox.set_vblank_sync(False)
+    raybox.queue_reg('sky', 1)
+    raybox.queue_reg('sky', 2) # Replaces the write above.
+    raybox.queue_reg('floor', 3)
+    raybox.commit(pov_bits(1.5, 2.5, 0.0))
+    raybox.commit(pov_bits(1.5, 2.5, 0.0)) # Same POV again, so suppressed.
+    raybox.flush()
+    assert conn.device.asic.regs == { 'sky': 2, 'floor': 3 }
+    assert conn.device.asic.counts == { 'reg': 2, 'pov': 1 }
+    assert raybox.stats['pov_suppressed'] == 1
+
+def test_vblank_sync(raybox, conn):
+    raybox.set_vblank_sync(True)
+    before = raybox.vblank_stats()
+    povs = [pov_bits(6.82, 9.5, 0.1*i) for i in range(20)]
+    for pov in povs: raybox.set_raw_pov(pov)
+    raybox.flush()
+    # Only the newest POV is sent, at the next vblank:
+    assert wait_for(lambda: conn.device.asic.pov == int(povs[-1], 2))
+    after = raybox.vblank_stats()
+    assert after['updated'] > before['updated']
+    assert after['dropped'] - before['dropped'] + after['updated'] - before['updated'] == len(povs)
+
+def test_error_replies(raybox, conn):
+    # A POV with non-zero padding is rejected by serve() (with b'E'), and doesn't reach the ASIC:
+    raybox.set_vblank_sync(False)
+    with pytest.raises(RayboxCommandError, match='padding') as e:
+        raybox.send_packet(b'P' + bytes(9) + b'\x01')
+        raybox.flush()
+    assert e.value.command == b'P' + bytes(9) + b'\x01'
+    assert conn.device.asic.counts['pov'] == 0
+    # An unknown command gets b'?':
+    with pytest.raises(RayboxCommandError, match='did not understand'):
+        raybox.send_packet(b'Z')
+        raybox.flush()
+    # Either way, the stream carries on:
+    raybox.set_sky(9)
+    raybox.flush()
+    assert conn.device.asic.regs['sky'] == 9
+
+def test_raw_exec_while_streaming(raybox, conn):
+    state = raybox.toggle_debug()
+    assert state == conn.device.tt.in3()
+    assert raybox.streaming
+    raybox.set_floor(4)
+    raybox.flush()
+    assert conn.device.asic.regs['floor'] == 4
+
+def test_fast_reconnect(raybox, conn, capsys, monkeypatch):
+    raybox.set_vblank_sync(False)
+    raybox.set_raw_pov(pov_bits(6.82, 9.5, 1.0))
+    raybox.flush()
+    pov = conn.device.asic.pov
+    # Abandon the session partway through a packet, with serve() still running:
+    raybox.write(pov_packet(pov_bits(1.0, 1.0, 0.0))[:5])
+    raybox.streaming = False
+    capsys.readouterr()
+    monkeypatch.setattr(RayboxZeroController, 'select_project', lambda *args: pytest.fail('Setup was not skipped'))
+    again = RayboxZeroController(conn=conn)
+    assert 'skipping setup and upload' in capsys.readouterr().out
+    # The partial packet was thrown away, rather than sent to the ASIC:
+    time.sleep(0.05)
+    assert conn.device.asic.pov == pov
+    assert conn.device.asic.counts['pov'] == 1
+    again.set_sky(11)
+    again.flush()
+    assert conn.device.asic.regs['sky'] == 11
+    again.stop_stream()
+
+def test_reconnect_after_change(raybox, conn, capsys):
+    raybox.exec('tt.clock_project_PWM(1000)')
+    raybox.stop_stream()
+    capsys.readouterr()
+    again = RayboxZeroController(conn=conn)
+    assert 'skipping setup and upload' not in capsys.readouterr().out
+    assert conn.device.tt.clock_hz == raybox_controller.CLOCK_SPEED
+    again.stop_stream()
+
+def test_async_controller(conn):
+    async def run():
+        raybox = await AsyncRayboxZeroController.open(conn=conn)
+        await raybox.set_sky(0b11_00_11)
+        await raybox.flush()
+        with pytest.raises(RayboxCommandError):
+            await raybox.send_packet(b'Z')
+            await raybox.flush()
+        assert await raybox.exec('print(tt.project)') == raybox_controller.PROJECT
+        await raybox.close()
+    asyncio.run(run())
+    assert conn.device.asic.regs['sky'] == 0b11_00_11
+
+def test_async_fast_reconnect(conn, capsys):
+    async def connect():
+        raybox = await AsyncRayboxZeroController.open(conn=conn)
+        state = await raybox.device_state()
+        await raybox.close()
+        return state
+    asyncio.run(connect())
+    # The first setup remembers the code it uploaded, so the next one (sync or async) can skip it all:
+    assert 'skipping setup and upload' not in capsys.readouterr().out
+    assert asyncio.run(connect())[4] is not None
+    assert 'skipping setup and upload' in capsys.readouterr().out
+    RayboxZeroController(conn=conn).stop_stream()
+    assert 'skipping setup and upload' in capsys.readouterr().out
@@ -39,6 +39,7 @@ class RBZSPI:
             )
         else:
             raise ValueError(f"Invalid interface {repr(interface)}; must be 'pov' or 'reg'")
+        self.buf = bytearray(16) # Preallocated for packing payloads (biggest is 74 bits).
         
     def __repr__(self): return f'RBZSPI({self.interface})'
 
@@ -51,45 +52,54 @@ class RBZSPI:
 
     def txn_stop(self): self.disable()
 
-    def to_bin(self, data, count=None):
-        if type(data) is int:
-            data = bin(data)
-            data = data[2:]
-            if count is None:
-                print(f"WARNING: SPI.send_bits() called with int data {data} but no count")
-        if count is not None:
-            data = ('0'*count + data)[-count:] # Zero-pad up to the required count.
-        return data
+    # Pack 'data' (as per send_payload()) MSB-first into our preallocated bytearray, zero-padded on the right
+    # to a whole number of bytes, without building any strings. Returns a memoryview of the packed bytes.
+    # (Most raybox-zero SPI payloads are not a multiple of 8 bits, but SoftSPI needs to send whole bytes.
+    # Thankfully raybox-zero SPI interfaces discard extra bits, so padding on the right is fine.)
+    def pack(self, data, count=None):
+        if type(data) is not list: data = [(data, count)]
+        buf = self.buf
+        pos = 0 # Bit position in buf.
+        for chunk in data:
+            if type(chunk) is tuple:
+                value, bits = chunk
+            else:
+                value, bits = chunk, None
+            if type(value) is str:
+                # String of binary digits, zero-padded (or trimmed) on the left to the required count:
+                if bits is None: bits = len(value)
+                j = len(value) - bits
+                for _ in range(bits):
+                    if pos & 7 == 0: buf[pos >> 3] = 0
+                    if j >= 0 and value[j] == '1': buf[pos >> 3] |= 0x80 >> (pos & 7)
+                    j += 1
+                    pos += 1
+            else:
+                if bits is None:
+                    raise ValueError(f"Integer data {value} needs a bit count")
+                # Shift in the lowest 'bits' bits of the integer, as many at a time as fit in the current byte:
+                while bits > 0:
+                    if pos & 7 == 0: buf[pos >> 3] = 0
+                    free = 8 - (pos & 7)
+                    take = free if free < bits else bits
+                    bits -= take
+                    buf[pos >> 3] |= ((value >> bits) & ((1 << take) - 1)) << (free - take)
+                    pos += take
+        return memoryview(buf)[:(pos + 7) >> 3]
 
+    # Do an SPI transaction.
+    # 'data' is one of:
+    # - bytes or a bytearray, sent as-is.
+    # - a string of binary digits, or an array thereof.
+    # - an integer (in which case 'count' must be specified also; i.e. required bit count).
+    # - an array of tuples; [0] is binary digit string or integer, [1] is required bit count.
     def send_payload(self, data, count=None, debug=False):
         if debug: start_time = time.ticks_us()
         self.txn_start()
         if type(data) is bytearray or type(data) is bytes:
             self.spi.write(data)
         else:
-            # Build up a binary string:
-            if type(data) is not list:
-                # Just send an explicit value (of a given optional 'count' size):
-                bin = self.to_bin(data, count)
-            else:
-                # Caller wants to concatenate multiple chunks in the one transaction
-                # (e.g. packed data):
-                bin = ''
-                for chunk in data:
-                    if type(chunk) is tuple:
-                        # Tuple means we have both data,
-                        # and the count of bits to transmit for that data:
-                        bin += self.to_bin(chunk[0], chunk[1])
-                    else:
-                        # Not a tuple, so hopefully it's a finite string of bits:
-                        bin += self.to_bin(chunk)
-            # Most raybox-zero SPI payloads are not a multiple of 8 bits,
-            # but this SoftSPI needs to send whole bytes.
-            # Thankfully raybox-zero SPI interfaces discard extra bits,
-            # so we now RIGHT-pad the binary string to a multiple of 8:
-            bin += '0' * (-len(bin) % 8)
-            # Convert this binary string to a bytearray and send it:
-            self.spi.write( int(bin,2).to_bytes(len(bin)//8, 'bin') )
+            self.spi.write(self.pack(data, count))
         self.txn_stop()
         if debug:
             stop_time = time.ticks_us()
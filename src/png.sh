@@ -1,7 +1,21 @@
 #/!usr/bin/bash
 
-for f in rbz_basic_frame-???.ppm; do
+# Frames can be written directly as PNGs (make FRAME_FORMAT=png), in which case
+# they're just copied. Otherwise, PPMs are converted if ImageMagick is available.
+DEST=${DEST:-~/HOST_Documents/ppm}
+
+for f in rbz_basic_frame-???.png; do
+    [ -e "$f" ] || continue
     echo $f
-    convert $f ~/HOST_Documents/ppm/$f.png
+    cp $f $DEST/$f
 done
 
+for f in rbz_basic_frame-???.ppm; do
+    [ -e "$f" ] || continue
+    if ! command -v convert >/dev/null; then
+        echo "Skipping $f: ImageMagick 'convert' not found (try: make FRAME_FORMAT=png)"
+        continue
+    fi
+    echo $f
+    convert $f $DEST/$f.png
+done
@@ -0,0 +1,159 @@
+# Frame sink used by test.py to collect captured video frames and write them out as images.
+# Pixels go into a preallocated RGB888 bytearray, and the whole frame is then written in one go
+# as either a binary PPM (P6) or a PNG (using only zlib, so ImageMagick's 'convert' isn't needed).
+# Frames (ours, or those converted by ImageMagick) can also be read back in as NumPy arrays. That takes
+# milliseconds, except for PNGs that use the Average or Paeth filters (as libpng/ImageMagick often do),
+# which take more like 0.1 seconds for a full frame.
+
+import struct
+import zlib
+import numpy as np
+
+FRAME_FORMATS = ['ppm', 'png']
+
+class FrameSink:
+    def __init__(self, width, height, format='ppm'):
+        if format not in FRAME_FORMATS:
+            raise ValueError(f"Invalid frame format {repr(format)}; must be one of {FRAME_FORMATS}")
+        self.width = width
+        self.height = height
+        self.format = format
+        self.stride = width*3
+        self.fb = bytearray(self.stride*height)
+
+    # Fill a whole line with packed RGB888 data (i.e. width*3 bytes):
+    def set_line(self, y, data):
+        self.fb[y*self.stride:(y+1)*self.stride] = data
+
+    # Fill the whole frame from an array of shape (height, width, 3):
+    def set_frame(self, rgb):
+        self.fb[:] = np.ascontiguousarray(rgb, dtype=np.uint8).tobytes()
+
+    # View of the framebuffer as a (height, width, 3) array, without copying it:
+    def array(self):
+        return np.frombuffer(self.fb, dtype=np.uint8).reshape(self.height, self.width, 3)
+
+    def set_pixel(self, x, y, rgb):
+        p = y*self.stride + x*3
+        self.fb[p:p+3] = bytes(rgb)
+
+    def ppm_bytes(self):
+        return f"P6\n{self.width} {self.height}\n255\n".encode('ascii') + self.fb
+
+    def png_bytes(self):
+        # Each PNG scanline is prefixed with its filter type; we always use 0 (None):
+        fb = memoryview(self.fb)
+        raw = b''.join(b'\x00' + fb[y*self.stride:(y+1)*self.stride] for y in range(self.height))
+        def chunk(tag, body):
+            return struct.pack('>I', len(body)) + tag + body + struct.pack('>I', zlib.crc32(tag+body) & 0xFFFFFFFF)
+        return (
+            b'\x89PNG\r\n\x1a\n' +
+            chunk(b'IHDR', struct.pack('>IIBBBBB', self.width, self.height, 8, 2, 0, 0, 0)) + # 8-bit RGB.
+            chunk(b'IDAT', zlib.compress(raw, 6)) +
+            chunk(b'IEND', b'')
+        )
+
+    # Write the frame to '<basename>.ppm' or '<basename>.png' (per our format), returning the filename:
+    def save(self, basename):
+        filename = f"{basename}.{self.format}"
+        with open(filename, 'wb') as f:
+            f.write(self.png_bytes() if self.format == 'png' else self.ppm_bytes())
+        return filename
+
+
+# Read a PPM (P3 or P6) or PNG (8-bit RGB or RGBA) image as an array of shape (height, width, 3):
+def read_frame(filename):
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data[:8] == b'\x89PNG\r\n\x1a\n':
+        return read_png(data)
+    elif data[:2] in [b'P3', b'P6']:
+        return read_ppm(data)
+    else:
+        raise ValueError(f"{filename} is not a PPM or PNG file")
+
+def read_ppm(data):
+    # Header is: magic, width, height, maxval (separated by whitespace, possibly with # comments):
+    fields = []
+    p = 0
+    while len(fields) < 4:
+        while data[p:p+1].isspace(): p += 1
+        if data[p:p+1] == b'#':
+            p = data.index(b'\n', p)
+            continue
+        start = p
+        while not data[p:p+1].isspace(): p += 1
+        fields.append(data[start:p])
+    magic, width, height, maxval = fields[0], int(fields[1]), int(fields[2]), int(fields[3])
+    if maxval != 255:
+        raise ValueError(f"Unsupported PPM maxval {maxval}")
+    if magic == b'P6':
+        pixels = np.frombuffer(data, dtype=np.uint8, count=width*height*3, offset=p+1)
+    else:
+        pixels = np.array(data[p:].split(), dtype=np.uint8)
+    return pixels.reshape(height, width, 3)
+
+def read_png(data):
+    p = 8
+    idat = []
+    while p < len(data):
+        length, tag = struct.unpack('>I4s', data[p:p+8])
+        body = data[p+8:p+8+length]
+        if tag == b'IHDR':
+            width, height, depth, color_type, _, _, interlace = struct.unpack('>IIBBBBB', body)
+            if depth != 8 or color_type not in [2, 6] or interlace != 0:
+                raise ValueError(f"Unsupported PNG: bit depth {depth}, color type {color_type}, interlace {interlace}")
+        elif tag == b'IDAT':
+            idat.append(body)
+        elif tag == b'IEND':
+            break
+        p += length + 12
+    bpp = 3 if color_type == 2 else 4
+    stride = width*bpp
+    raw = np.frombuffer(zlib.decompress(b''.join(idat)), dtype=np.uint8).reshape(height, stride+1)
+    filters = raw[:,0]
+    if filters.max(initial=0) > 4:
+        raise ValueError(f"Unsupported PNG filter type {filters.max()}")
+    if filters.max(initial=0) >= 3:
+        return unfilter_png_diagonals(raw[:,1:].reshape(height, width, bpp), filters)[:,:,0:3]
+    pixels = np.zeros((height, stride), dtype=np.uint8)
+    prior = np.zeros(stride, dtype=np.uint8)
+    for y in range(height):
+        filter_type, line = raw[y,0], raw[y,1:]
+        if filter_type == 0: # None
+            out = line
+        elif filter_type == 1: # Sub: Add the byte 1 pixel to the left, i.e. a running sum per channel:
+            out = np.cumsum(line.reshape(width, bpp), axis=0, dtype=np.uint8).reshape(stride)
+        else: # Up
+            out = line + prior
+        pixels[y] = prior = out
+    return pixels.reshape(height, width, bpp)[:,:,0:3]
+
+# Undo PNG filtering of 'data' (shape (height, width, bpp)) where some rows use Average (3) or Paeth (4).
+# Each of those pixels depends on the (already unfiltered) pixels to its left, above, and above-left,
+# so a row can't be done all at once, but every pixel on the same anti-diagonal (i.e. the same y+x) only
+# depends on earlier diagonals. The rows are therefore sheared (row y shifted right by y), so that each
+# diagonal is a column, and then done one column at a time, across all rows (of any filter type):
+def unfilter_png_diagonals(data, filters):
+    height, width, bpp = data.shape
+    diagonals = height + width - 1
+    # Sheared input, and output (indexed [diagonal, row], so each diagonal is contiguous), with 2 extra
+    # diagonals of zeros before the first, and an extra row of zeros above:
+    sheared = np.zeros((diagonals, height, bpp), dtype=np.int16)
+    out = np.zeros((diagonals+2, height+1, bpp), dtype=np.int16)
+    for y in range(height): sheared[y:y+width, y] = data[y]
+    use = [(filters == f).astype(np.int16)[:,None] for f in [1, 2, 3, 4]]
+    for d in range(diagonals):
+        y0, y1 = max(0, d-width+1), min(height, d+1)
+        # Pixel (y, x=d-y) is at out[d+2, y+1]; the one to its left is on the previous diagonal,
+        # the one above it too (but one row up), and the one above-left is two diagonals back:
+        left, up, upleft = out[d+1, y0+1:y1+1], out[d+1, y0:y1], out[d, y0:y1]
+        pa, pb, pc = np.abs(up - upleft), np.abs(left - upleft), np.abs(left + up - 2*upleft)
+        paeth = np.where((pa <= pb) & (pa <= pc), left, np.where(pb <= pc, up, upleft))
+        sub, up_, avg, pae = (u[y0:y1] for u in use)
+        pred = left*sub + up*up_ + ((left + up) >> 1)*avg + paeth*pae
+        out[d+2, y0+1:y1+1] = (sheared[d, y0:y1] + pred) & 0xFF
+    # Unshear:
+    pixels = np.empty((height, width, bpp), dtype=np.uint8)
+    for y in range(height): pixels[y] = out[y+2:y+2+width, y+1]
+    return pixels
@@ -0,0 +1,66 @@
+# Golden-image regression checking for frames captured by test.py.
+# Each captured frame is compared (as a whole NumPy array, so it takes milliseconds)
+# against a stored reference frame of the same name in a 'golden' directory.
+
+import os
+import numpy as np
+from frames import read_frame
+
+# Result of comparing an actual frame against its expected (reference) frame:
+class FrameDiff:
+    def __init__(self, actual, expected):
+        self.shape_ok = actual.shape == expected.shape
+        if not self.shape_ok:
+            self.delta = None
+            self.mismatch = None
+            self.mismatches = actual.shape[0]*actual.shape[1]
+            self.bbox = None
+            self.max_delta = None
+            return
+        self.expected = expected
+        if np.array_equal(actual, expected):
+            # The usual case, so skip the rest:
+            self.delta = None
+            self.mismatch = None
+            self.mismatches = 0
+            self.max_delta = 0
+            self.bbox = None
+            return
+        # Per-pixel sum of absolute channel differences, and which pixels differ at all:
+        self.delta = np.abs(actual.astype(np.int16) - expected.astype(np.int16)).sum(axis=2)
+        self.mismatch = self.delta > 0
+        self.mismatches = int(np.count_nonzero(self.mismatch))
+        self.max_delta = int(self.delta.max()) if self.delta.size else 0
+        if self.mismatches:
+            rows = np.flatnonzero(self.mismatch.any(axis=1))
+            cols = np.flatnonzero(self.mismatch.any(axis=0))
+            self.bbox = (int(cols[0]), int(rows[0]), int(cols[-1]), int(rows[-1])) # (x0, y0, x1, y1), inclusive.
+        else:
+            self.bbox = None
+
+    def __repr__(self):
+        if not self.shape_ok:
+            return 'FrameDiff(shape mismatch)'
+        return f'FrameDiff(mismatches={self.mismatches}, bbox={self.bbox}, max_delta={self.max_delta})'
+
+    # Heatmap showing the expected frame dimmed to 1/4 brightness (in grey),
+    # with mismatched pixels in red, brighter for bigger differences:
+    def heatmap(self):
+        grey = (self.expected.astype(np.uint16).sum(axis=2) // 12).astype(np.uint8)
+        heat = np.stack([grey, grey, grey], axis=2)
+        if self.mismatches:
+            level = 96 + (self.delta[self.mismatch] * 159 // max(self.max_delta, 1))
+            heat[self.mismatch] = np.stack([level, np.zeros_like(level), np.zeros_like(level)], axis=1)
+        return heat
+
+# Find the reference frame for 'name' (e.g. 'rbz_basic_frame-000') in 'golden_dir',
+# in whichever format it happens to be stored:
+def find_golden(golden_dir, name):
+    for ext in ['png', 'ppm']:
+        path = os.path.join(golden_dir, f'{name}.{ext}')
+        if os.path.exists(path):
+            return path
+    return None
+
+def compare_frame(actual, golden_path):
+    return FrameDiff(actual, read_frame(golden_path))
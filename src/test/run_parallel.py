@@ -0,0 +1,76 @@
+# Splits test_frames across multiple independent simulator processes, e.g. so that
+# `make parallel FRAMES=16 JOBS=8` renders frames 0..15 using 8 copies of Icarus.
+#
+# In demo mode (inc_px/inc_py asserted) each frame depends only on its frame number
+# (counted from reset), so each job is given its own START_FRAME and fast-forwards to it
+# with output sampling disabled, then renders its share of frames. Frame files are
+# already named by absolute frame number, so they all just land in src/ side-by-side,
+# and each job's results file is merged into the usual results.xml at the end.
+#
+# This is meant to be run from src/ (where the Makefile is), via `make parallel`,
+# which first makes sure the simulation is compiled so that the jobs can share it.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+import xml.etree.ElementTree as ET
+
+# Split 'frames' into up to 'jobs' contiguous (start_frame, frame_count) ranges:
+def shard_frames(frames, jobs):
+    jobs = max(1, min(jobs, frames))
+    shards = []
+    start = 0
+    for j in range(jobs):
+        count = frames//jobs + (1 if j < frames%jobs else 0)
+        shards.append((start, count))
+        start += count
+    return shards
+
+# Combine the test cases of each job's results file into one results file.
+# Each test case is renamed to show which frames it covered:
+def merge_results(shard_results, merged_file):
+    merged = ET.Element('testsuites', name='results')
+    suite = ET.SubElement(merged, 'testsuite', name='all', package='all')
+    for (start, count), results_file in shard_results:
+        if not os.path.exists(results_file):
+            # The job didn't even get to write its results, so record that as a failure:
+            case = ET.SubElement(suite, 'testcase', name=f'frames_{start}_{start+count-1}', classname='run_parallel')
+            ET.SubElement(case, 'failure', message=f'No results file: {results_file}')
+            continue
+        for case in ET.parse(results_file).getroot().iter('testcase'):
+            case.set('name', f"{case.get('name')}[frames_{start}_{start+count-1}]")
+            suite.append(case)
+    ET.ElementTree(merged).write(merged_file, encoding='UTF-8', xml_declaration=True)
+    return sum(1 for _ in suite.iter('failure')) + sum(1 for _ in suite.iter('error'))
+
+def main():
+    parser = argparse.ArgumentParser(description='Render test_frames using several simulators in parallel')
+    parser.add_argument('--frames', type=int, default=int(os.environ.get('FRAMES') or 10), help='Total frames to render')
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help='Number of simulators to run at once')
+    parser.add_argument('--results', default='results.xml', help='Merged results file to write')
+    parser.add_argument('--make', default=os.environ.get('MAKE') or 'make', help='make command to run each job with')
+    args = parser.parse_args()
+
+    shards = shard_frames(args.frames, args.jobs)
+    print(f"Rendering {args.frames} frame(s) across {len(shards)} job(s): {shards}")
+    start_time = time.time()
+    procs = []
+    for start, count in shards:
+        env = dict(os.environ, START_FRAME=str(start), FRAMES=str(count))
+        results_file = f"results-frames-{start:03d}.xml"
+        log = open(f"results-frames-{start:03d}.log", 'w')
+        if os.path.exists(results_file): os.remove(results_file)
+        cmd = [args.make, f'COCOTB_RESULTS_FILE={results_file}']
+        procs.append(((start, count), results_file, log, subprocess.Popen(cmd, env=env, stdout=log, stderr=subprocess.STDOUT)))
+    for (start, count), results_file, log, proc in procs:
+        proc.wait()
+        log.close()
+        print(f"Frames {start}..{start+count-1}: make exited with {proc.returncode} (see {log.name})")
+    failures = merge_results([(shard, results_file) for shard, results_file, _, _ in procs], args.results)
+    print(f"Done in {time.time()-start_time:.2f} seconds; {failures} failure(s) merged into {args.results}")
+    return 1 if failures else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
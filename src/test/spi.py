@@ -0,0 +1,147 @@
+# SPI driver used by test.py to stream POV and register updates into the design's two SPI
+# peripherals (pov_* and reg_* in tb.v), the same way the RP2040 on the TT04 demoboard does
+# with SoftSPI (mode 0, MSB first), while frames are being captured.
+#
+# Updates come from a stream file (see parse_stream) or are generated (see spin_stream).
+# raybox-zero only takes on new POV/register values when the visible frame ends (i.e. when
+# o_vblank rises), so UpdateStream also watches o_vblank to work out how many updates each
+# frame absorbed, and how long it took for them to become visible (when o_vblank falls).
+
+import math
+from cocotb.triggers import Timer, RisingEdge, FallingEdge
+from cocotb.utils import get_sim_time
+
+# Register command IDs per
+# https://github.com/algofoogle/raybox-zero/blob/922aa8e901d1d3e54e35c5253b0a44d7b32f681f/src/rtl/spi_registers.v#L77
+REG_CMDS = {'sky': 0, 'floor': 1, 'leak': 2}
+
+POV_BITS = 74 # UQ6.9 px, py; SQ2.9 fx, fy, vx, vy
+REG_BITS = 10 # 4-bit command, 6-bit value
+
+# Make a 74-bit POV (as an int) from floats, as Player.fixed() in demoboard/raybox_game.py does:
+def pov_from_floats(px, py, fx, fy, vx, vy):
+    pov = 0
+    for v, bits in [(px, 15), (py, 15), (fx, 11), (fy, 11), (vx, 11), (vy, 11)]:
+        pov = (pov << bits) | (int(v*512.0) & ((1<<bits)-1))
+    return pov
+
+def reg_update(name, value):
+    return ('reg', (REG_CMDS[name] << 6) | (value & 0b111111), REG_BITS)
+
+# Parse a stream file's lines into a list of updates, each being (interface, value, bits).
+# One update per line (blank lines and # comments are ignored):
+#   pov <74 binary digits>              e.g. as sent by raybox_controller.py
+#   pov <px> <py> <fx> <fy> <vx> <vy>   as floats
+#   sky <n> / floor <n> / leak <n>      register writes; n can be decimal, or 0b.../0x...
+def parse_stream(lines):
+    updates = []
+    for n, line in enumerate(lines, 1):
+        words = line.split('#', 1)[0].split()
+        if not words: continue
+        cmd, args = words[0].lower(), words[1:]
+        if cmd == 'pov' and len(args) == 1 and len(args[0]) == POV_BITS:
+            updates.append(('pov', int(args[0], 2), POV_BITS))
+        elif cmd == 'pov' and len(args) == 6:
+            updates.append(('pov', pov_from_floats(*map(float, args)), POV_BITS))
+        elif cmd in REG_CMDS and len(args) == 1:
+            updates.append(reg_update(cmd, int(args[0], 0)))
+        else:
+            raise ValueError(f"Invalid stream update on line {n}: {line.strip()}")
+    return updates
+
+def read_stream(filename):
+    with open(filename) as f:
+        return parse_stream(f)
+
+# Generate a stream of POVs that turn the player a full circle on the spot (in 'steps' updates),
+# so that every update is different:
+def spin_stream(steps, px=6.82, py=9.5):
+    updates = []
+    for i in range(steps):
+        a = 2.0*math.pi*i/steps
+        sina, cosa = math.sin(a), math.cos(a)
+        updates.append(('pov', pov_from_floats(px, py, sina, cosa, -cosa*0.5, sina*0.5), POV_BITS))
+    return updates
+
+# Drives one SPI peripheral's sclk/mosi/ss_n in mode 0 (sclk idles low; the design samples
+# mosi on the rising edge), with a bit period of 2*half_period sim steps:
+class SpiDriver:
+    def __init__(self, sclk, mosi, ss_n, half_period):
+        self.sclk = sclk
+        self.mosi = mosi
+        self.ss_n = ss_n
+        self.half_period = half_period
+
+    def idle(self):
+        self.ss_n.value = 1
+        self.sclk.value = 0
+        self.mosi.value = 0
+
+    # Send the lowest 'bits' bits of 'value', MSB first, as one transaction:
+    async def send(self, value, bits):
+        self.sclk.value = 0
+        self.ss_n.value = 0
+        for i in range(bits-1, -1, -1):
+            self.mosi.value = (value >> i) & 1
+            await Timer(self.half_period, units='step')
+            self.sclk.value = 1
+            await Timer(self.half_period, units='step')
+            self.sclk.value = 0
+        await Timer(self.half_period, units='step')
+        self.ss_n.value = 1
+
+# Sends a list of updates (per parse_stream) to the design, and keeps track of which frame each
+# one lands in. 'clock_period' is the clk period in sim steps; each SPI bit takes 'clocks_per_bit'
+# clocks, and updates start every 'interval' clocks (or back-to-back, if that's too short):
+class UpdateStream:
+    def __init__(self, dut, updates, clock_period, clocks_per_bit=8, interval=0):
+        self.dut = dut
+        self.updates = updates
+        half_period = max(1, clocks_per_bit*clock_period//2)
+        self.pov = SpiDriver(dut.pov_sclk, dut.pov_mosi, dut.pov_ss_n, half_period)
+        self.reg = SpiDriver(dut.reg_sclk, dut.reg_mosi, dut.reg_ss_n, half_period)
+        self.interval = interval*clock_period
+        self.gap = 2*half_period # Minimum time with ss_n deasserted between transactions.
+        self.sent = 0
+        self.pending = []   # Sim times (ns) at which each update since the last latch finished sending.
+        self.frames = []    # Per latched frame: (updates absorbed, latency of newest, latency of oldest) in ns.
+        self.latencies = [] # Per update: ns from finishing sending it, until the frame showing it (or a newer one) starts.
+
+    def idle(self):
+        self.pov.idle()
+        self.reg.idle()
+
+    async def run(self):
+        for interface, value, bits in self.updates:
+            start = get_sim_time('step')
+            await (self.pov if interface == 'pov' else self.reg).send(value, bits)
+            self.pending.append(get_sim_time('ns'))
+            self.sent += 1
+            await Timer(max(self.gap, self.interval - (get_sim_time('step') - start)), units='step')
+
+    # Watch o_vblank: updates that finished before it rises are latched for the next frame,
+    # which becomes visible when it falls:
+    async def monitor(self):
+        while True:
+            await RisingEdge(self.dut.o_vblank)
+            latched, self.pending = self.pending, []
+            await FallingEdge(self.dut.o_vblank)
+            if not latched: continue
+            visible = get_sim_time('ns')
+            self.latencies += [visible - t for t in latched]
+            self.frames.append((len(latched), visible - latched[-1], visible - latched[0]))
+            self.dut._log.info(
+                f"Frame starting at {visible/1e6:.3f} ms absorbed {len(latched)} update(s) "
+                f"({len(latched)-1} superseded); newest visible after {(visible-latched[-1])/1e3:.1f} us"
+            )
+
+    def summary(self):
+        if not self.latencies:
+            return f"Sent {self.sent} of {len(self.updates)} update(s); none became visible yet"
+        absorbed = [f[0] for f in self.frames]
+        return (
+            f"Sent {self.sent} of {len(self.updates)} update(s); {len(self.latencies)} became visible over {len(self.frames)} frame(s), "
+            f"{min(absorbed)}..{max(absorbed)} (mean {sum(absorbed)/len(absorbed):.1f}) per frame; "
+            f"latency {min(self.latencies)/1e3:.1f}..{max(self.latencies)/1e3:.1f} us "
+            f"(mean {sum(self.latencies)/len(self.latencies)/1e3:.1f} us)"
+        )
@@ -76,4 +76,15 @@ module tb;
         .rst_n      (rst_n)     // reset_n - low to reset
     );
 
+    // --- Line capture buffer, drained by test.py once per line: ---
+    // On each rising clk edge, the current uo_out (as it was just before the edge) is
+    // shifted in at the LSB end, so after LINE_CAPTURE_PIXELS clocks the oldest sample
+    // is in the top byte. This saves Python from having to wake up on every pixel clock.
+    `ifndef LINE_CAPTURE_PIXELS
+        `define LINE_CAPTURE_PIXELS 800
+    `endif
+    localparam LCW = 8*`LINE_CAPTURE_PIXELS;
+    reg [LCW-1:0] line_capture;
+    always @(posedge clk) line_capture <= {line_capture[LCW-9:0], uo_out};
+
 endmodule
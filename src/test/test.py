@@ -1,13 +1,125 @@
 import cocotb
 from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge, Timer, ClockCycles
+from cocotb.utils import get_sim_steps, get_sim_time
 import time
+import os
 from os import environ as env
+from frames import FrameSink
+from golden import find_golden, compare_frame
+from spi import UpdateStream, read_stream, spin_stream
 
 HIGH_RES        = float(env.get('HIGH_RES')) if 'HIGH_RES' in env else None # If not None, scale H res by this, and step by CLOCK_PERIOD/HIGH_RES instead of unit clock cycles.
 CLOCK_PERIOD    = float(env.get('CLOCK_PERIOD') or 40.0) # Default 40.0 (period of clk oscillator input, in nanoseconds)
 FRAMES          =   int(env.get('FRAMES')       or   10) # Default 3 (total frames to render)
+START_FRAME     =   int(env.get('START_FRAME')  or    0) # Default 0 (frames before this are simulated, but not sampled or written)
 LINE_MOD        =   int(env.get('LINE_MOD')     or    1) # Default 1 (how often to report current line number: every N lines)
+LINE_CAPTURE    =   int(env.get('LINE_CAPTURE') or    1) # Default 1 (drain tb.line_capture once per line instead of sampling every clock; ignored if HIGH_RES)
+FRAME_FORMAT    =       env.get('FRAME_FORMAT') or 'ppm' # Default 'ppm' (binary P6), or 'png'
+GOLDEN_DIR      =       env.get('GOLDEN_DIR')   or 'test/golden' # Where reference frames (rbz_basic_frame-NNN.png/.ppm) are kept
+GOLDEN_TOLERANCE=   int(env.get('GOLDEN_TOLERANCE') or 0) # Default 0 (max. no. of mismatched pixels allowed per frame)
+GOLDEN_UPDATE   =   int(env.get('GOLDEN_UPDATE') or   0) # Default 0 (if 1, write captured frames to GOLDEN_DIR as the new references)
+GOLDEN_REQUIRED =   int(env.get('GOLDEN_REQUIRED') or (1 if env.get('CI') and os.path.isdir(GOLDEN_DIR) else 0)) # Default 0, or 1 in CI once GOLDEN_DIR exists (if 1, a frame with no golden reference fails)
+POV_STREAM      =       env.get('POV_STREAM')   or None # Default None (demo mode), else a stream file of POV/register updates to send via SPI, or 'spin'
+SPIN_STEPS      =   int(env.get('SPIN_STEPS')   or   64) # Default 64 (no. of POVs in a POV_STREAM=spin full turn)
+SPI_CLOCKS_PER_BIT= int(env.get('SPI_CLOCKS_PER_BIT') or 8) # Default 8 (clk cycles per SPI bit when streaming)
+STREAM_INTERVAL =   int(env.get('STREAM_INTERVAL') or 0) # Default 0 (clk cycles from the start of one streamed update to the next; 0 means back-to-back)
+
+# Convert one 8-bit uo_out sample (as a binstr: Bb Gg Rr vsync_n hsync_n) to the
+# (r,g,b) that we write to our output image:
+def decode_pixel(bits):
+    if 'x' in bits[0:6]:
+        # Output is unknown; make it green:
+        return (0, 255, 0)
+    rr = int(bits[4:6], 2)
+    gg = int(bits[2:4], 2)
+    bb = int(bits[0:2], 2)
+    hsyncb = 255 if bits[7]=='x' else (bits[7]=='0')*0b110000
+    vsyncb = 128 if bits[6]=='x' else (bits[6]=='0')*0b110000
+    return (
+        (rr << 6) | hsyncb,
+        (gg << 6) | vsyncb,
+        (bb << 6)
+    )
+
+# There are only a handful of distinct samples (256, plus some with 'x' in them),
+# so cache the RGB888 bytes that each one turns into in the output image:
+pixel_cache = {}
+def pixel_bytes(bits):
+    t = pixel_cache.get(bits)
+    if t is None:
+        t = pixel_cache[bits] = bytes(decode_pixel(bits))
+    return t
+
+# Drains tb's line_capture buffer, which shifts in one uo_out sample per rising clk edge.
+# Rather than counting clocks in Python (which means a callback per clock), we wake up
+# once per line using a Timer aimed a fraction of a clock after the last edge of the line:
+class LineCapture:
+    def __init__(self, dut, count):
+        self.dut = dut
+        self.count = count # Pixels (i.e. clocks) per line.
+        self.period = get_sim_steps(CLOCK_PERIOD, 'ns')
+        self.next = None
+
+    # Call this on a rising clk edge: it becomes the first sample of the next line.
+    def sync(self):
+        self.next = get_sim_time('step') + (self.count-1)*self.period + self.period//4
+
+    # Let the whole line run in the simulator, then return all of its samples
+    # as one binstr (oldest sample first, 8 bits per pixel):
+    async def line(self):
+        await self.skip()
+        return self.dut.line_capture.value.binstr[-8*self.count:]
+
+    # Let one or more whole lines run in the simulator (in a single wait), without reading them:
+    async def skip(self, lines=1):
+        self.next += (lines-1)*self.count*self.period
+        await Timer(self.next - get_sim_time('step'), units='step')
+        self.next += self.count*self.period
+
+# Let 'count' clocks run without waking up Python on each one (as ClockCycles would),
+# ending on a rising clk edge:
+async def fast_forward(dut, count):
+    period = get_sim_steps(CLOCK_PERIOD, 'ns')
+    await Timer(count*period - period//2, units='step')
+    await RisingEdge(dut.clk)
+
+# Compare the frame in 'sink' against its golden reference (if there is one), writing a
+# heatmap (rbz_diff_frame-NNN.png) of any differences. Returns False if there are too many,
+# or if there is no reference and GOLDEN_REQUIRED is set.
+# With GOLDEN_UPDATE=1, this instead stores the frame as the new reference.
+def check_golden(dut, sink, name):
+    if GOLDEN_UPDATE:
+        os.makedirs(GOLDEN_DIR, exist_ok=True)
+        ref = FrameSink(sink.width, sink.height, 'png')
+        ref.fb[:] = sink.fb
+        dut._log.info(f"Updated golden reference {ref.save(os.path.join(GOLDEN_DIR, name))}")
+        return True
+    golden_path = find_golden(GOLDEN_DIR, name)
+    if golden_path is None:
+        if GOLDEN_REQUIRED:
+            dut._log.error(f"No golden reference for {name} in {GOLDEN_DIR}, and GOLDEN_REQUIRED is set")
+            return False
+        dut._log.warning(f"No golden reference for {name} in {GOLDEN_DIR}; not checked")
+        return True
+    diff_start_time = time.time()
+    diff = compare_frame(sink.array(), golden_path)
+    diff_ms = (time.time()-diff_start_time)*1000.0
+    if not diff.shape_ok:
+        dut._log.error(f"{name} is not the same size as {golden_path}")
+        return False
+    if diff.mismatches == 0:
+        dut._log.info(f"{name} matches {golden_path} (compared in {diff_ms:.1f} ms)")
+        return True
+    heat = FrameSink(sink.width, sink.height, 'png')
+    heat.set_frame(diff.heatmap())
+    heat_file = heat.save(name.replace('_frame-', '_diff_frame-'))
+    ok = diff.mismatches <= GOLDEN_TOLERANCE
+    (dut._log.warning if ok else dut._log.error)(
+        f"{name} differs from {golden_path}: {diff.mismatches} pixel(s) (tolerance {GOLDEN_TOLERANCE}) "
+        f"in bbox {diff.bbox}, max delta {diff.max_delta}; see {heat_file} (compared in {diff_ms:.1f} ms)"
+    )
+    return ok
 
 # Make sure all bidir pins are configured as outputs
 # (as they should always be, for this design):
@@ -27,9 +139,9 @@ def set_default_start_state(dut):
     dut.reg_ss_n.value = 1
     # Enable debug display on-screen:
     dut.debug.value = 1
-    # Enable demo mode (player position auto-increment):
-    dut.inc_px.value = 1
-    dut.inc_py.value = 1
+    # Enable demo mode (player position auto-increment), unless the POV is coming from a stream instead:
+    dut.inc_px.value = 0 if POV_STREAM else 1
+    dut.inc_py.value = 0 if POV_STREAM else 1
     # Present UNregistered outputs:
     dut.registered_outputs.value = 0
 
@@ -37,19 +149,31 @@ def set_default_start_state(dut):
 @cocotb.test()
 async def test_frames(dut):
     """
-    Generate first video frame and write it to rbz_basic_frames.ppm
+    Generate video frames and write them to rbz_basic_frame-NNN.ppm (or .png, per FRAME_FORMAT),
+    or rbz_stream_frame-NNN.ppm when POV_STREAM is sending updates via SPI
     """
 
     dut._log.info("Starting test_frames...")
 
-    frame_count = FRAMES # No. of frames to render.
+    frame_count = START_FRAME+FRAMES # No. of frames to simulate, of which the last FRAMES are rendered.
     hrange = 800
     frame_height = 525
     #vrange = frame_height*frame_count #NOTE: Can multiply this by number of frames desired.
     vrange = frame_height
     hres = HIGH_RES or 1
+    # HIGH_RES samples between clock edges, so it can't use the clocked capture buffer:
+    line_capture = LineCapture(dut, hrange) if LINE_CAPTURE and HIGH_RES is None else None
+    # Preallocated framebuffer that each frame is written into, before being saved in one go:
+    sink = FrameSink(int(hrange*hres), vrange, FRAME_FORMAT)
+    golden_failures = []
+    stream = None
+    if POV_STREAM:
+        updates = spin_stream(SPIN_STEPS) if POV_STREAM == 'spin' else read_stream(POV_STREAM)
+        stream = UpdateStream(dut, updates, get_sim_steps(CLOCK_PERIOD, 'ns'), SPI_CLOCKS_PER_BIT, STREAM_INTERVAL)
+        dut._log.info(f"Streaming {len(updates)} update(s) from {POV_STREAM} at {SPI_CLOCKS_PER_BIT} clocks per SPI bit")
 
     set_default_start_state(dut)
+    if stream: stream.idle()
     # Start with reset released:
     dut.rst_n.value = 1
 
@@ -68,27 +192,42 @@ async def test_frames(dut):
     dut._log.info("Release reset...")
     # ...then release reset:
     dut.rst_n.value = 1
+    if line_capture: line_capture.sync()
+    if stream:
+        # Send updates concurrently with rendering:
+        cocotb.start_soon(stream.monitor())
+        cocotb.start_soon(stream.run())
 
     dut._log.info("Starting frame rendering loop...")
 
-    for frame in range(frame_count):
-        render_start_time = time.time()
-        # Create PPM file to visualise the frame, and write its header:
-        img = open(f"rbz_basic_frame-{frame:03d}.ppm", "w")
-        img.write("P3\n")
-        img.write(f"{int(hrange*hres)} {vrange:d}\n")
-        img.write("255\n")
+    if START_FRAME > 0:
+        # Fast-forward to START_FRAME in one wait, with no per-pixel (or even per-line) Python work:
+        dut._log.info(f"Fast-forwarding through {START_FRAME} frame(s) to reach frame {START_FRAME+1}...")
+        skip_start_time = time.time()
+        if line_capture:
+            await line_capture.skip(vrange*START_FRAME)
+        else:
+            await fast_forward(dut, hrange*vrange*START_FRAME)
+        dut._log.info(f"[Skipped {START_FRAME} frame(s) in {time.time()-skip_start_time:.2f} seconds]")
 
+    for frame in range(START_FRAME, frame_count):
+        render_start_time = time.time()
         dut._log.info(f"Starting frame {frame+1} of {frame_count}...")
 
-        for n in range(vrange): # 525 lines * however many frames in frame_count
-            if (n % LINE_MOD) == 0:
+        for y in range(vrange): # 525 lines * however many frames in frame_count
+            if (y % LINE_MOD) == 0:
                 print()
-                dut._log.info(f"Rendering line {n+1} of frame {frame+1} of {frame_count}")
+                dut._log.info(f"Rendering line {y+1} of frame {frame+1} of {frame_count}")
             else:
                 print('.', end='')
-            for n in range(int(hrange*hres)): # 800 pixel clocks per line.
-                # if n % 100 == 0:
+            if line_capture:
+                # Let the whole line (800 pixel clocks) run in the simulator,
+                # then decode it from tb's capture buffer in one go:
+                bits = await line_capture.line()
+                sink.set_line(y, b''.join(pixel_bytes(bits[p:p+8]) for p in range(0, len(bits), 8)))
+                continue
+            for x in range(int(hrange*hres)): # 800 pixel clocks per line.
+                # if x % 100 == 0:
                 #     print('.', end='')
                 if 'x' in dut.rgb.value.binstr:
                     # Output is unknown; make it green:
@@ -104,15 +243,20 @@ async def test_frames(dut):
                     r = (rr << 6) | hsyncb
                     g = (gg << 6) | vsyncb
                     b = (bb << 6)
-                img.write(f"{r} {g} {b}\n")
+                sink.set_pixel(x, y, (int(r), int(g), int(b)))
                 if HIGH_RES is None:
                     await ClockCycles(dut.clk, 1) 
                 else:
                     await Timer(CLOCK_PERIOD/hres, units='ns')
-        img.close()
+        name = f"rbz_{'stream' if stream else 'basic'}_frame-{frame:03d}"
+        filename = sink.save(name)
         render_stop_time = time.time()
         delta = render_stop_time - render_start_time
-        dut._log.info(f"[{render_stop_time}: Frame simulated in {delta:.2f} seconds]")
+        dut._log.info(f"[{render_stop_time}: Frame simulated in {delta:.2f} seconds; wrote {filename}]")
+        if not check_golden(dut, sink, name):
+            golden_failures.append(name)
     dut._log.info("Waiting 1 more clock, for start of next line...")
     await ClockCycles(dut.clk, 1)
+    if stream: dut._log.info(stream.summary())
+    assert not golden_failures, f"{len(golden_failures)} frame(s) didn't match (or are missing) their golden references: {golden_failures}"
     dut._log.info("DONE")